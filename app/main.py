@@ -1,582 +1,4160 @@
 import sys
 import os
-import subprocess
-from pathlib import Path
-import readline
+import stat
+import io
+import itertools
+import atexit
+import mmap
+import signal
+import struct
+import re
+import resource
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+# subprocess, shlex, readline and ctypes are imported where they are first
+# needed: a `-c true` run or a script of builtins never pays for them
+readline = None
 
-list_buildin_cmd = ['exit', 'echo', 'type', 'pwd', 'cd', 'history']
 last_completion_text = None
 last_matches = []
 tab_count = 0
-history = []
 history_file_positions = {}
+history_file = None
+history_index = None
+# lines readline holds from $HISTFILE that are not yet in the history list
+history_pending = 0
+last_exit_status = 0
+# variables not exported to children; exported ones live in os.environ
+shell_variables = {}
+aliases = {}
+# name -> compound command body
+functions = {}
+# how many loops and function calls are running, for break and return
+loop_depth = 0
+function_depth = 0
+# $0 followed by the script arguments
+positional_parameters = [sys.argv[0]]
+last_background_pid = None
+substitution_status = None
+
+# per-child limits: ulimit option -> (description, unit, rlimit, scale, env var);
+# 'T' is wall-clock time, enforced by an ITIMER_REAL the child inherits
+RESOURCE_LIMITS = {
+    't': ('cpu time', 'seconds', resource.RLIMIT_CPU, 1, 'SHELL_CPU_LIMIT'),
+    'v': ('virtual memory', 'kbytes', resource.RLIMIT_AS, 1024, 'SHELL_MEMORY_LIMIT'),
+    'n': ('open files', '', resource.RLIMIT_NOFILE, 1, 'SHELL_NOFILE_LIMIT'),
+    'T': ('wall-clock time', 'seconds', None, 1, 'SHELL_TIMEOUT'),
+}
+session_limits = {}
+
+# external commands start through os.posix_spawn where the platform has it;
+# Python ignores SIGPIPE and SIGXFSZ, which children must get back
+use_posix_spawn = hasattr(os, 'posix_spawn')
+spawn_env = None
+SPAWN_DEFAULT_SIGNALS = [
+    getattr(signal, name) for name in ('SIGPIPE', 'SIGXFSZ') if hasattr(signal, name)
+]
+
+# job table: job number -> Job; job_control is only enabled for interactive use
+jobs = {}
+job_control = False
+
+# command hash table: name -> [path, hits], and per-directory listings as
+# (mtime, {name: path}, generation); path_index_warming is set while the
+# startup thread is still filling them
+hashed_commands = {}
+hashed_path_env = None
+path_dir_cache = {}
+path_dir_generation = itertools.count()
+path_index_warming = threading.Event()
+path_watcher = None
+path_executables = (None, [])
+
+# completion: sorted command names keyed like path_executables, and sorted
+# directory listings keyed by mtime
+command_names = (None, [])
+directory_listings = {}
+
+SCRIPT_OUTPUT_BUFFER = 1 << 16
+
+# parsed pipeline lists keyed by raw input line, least recently used first
+PARSE_CACHE_SIZE = 512
+parse_cache = OrderedDict()
+parse_cache_stats = {'hits': 0, 'misses': 0}
+path_stats = {'hash hits': 0, 'hash misses': 0, 'directory scans': 0, 'index builds': 0}
+
+# phase timings and the JSON-lines trace are opt-in ($SHELLSTATS,
+# $SHELLTRACE or `shellstats on`); while off, nothing is wrapped
+stats = None
+
+
+def get_path_dirs():
+    """ Return PATH directories, dropping the hash table when PATH changes """
+    global hashed_path_env
+
+    path_env = os.environ.get('PATH', '')
+    if path_env != hashed_path_env:
+        hashed_commands.clear()
+        hashed_path_env = path_env
+
+    return [d for d in path_env.split(':') if d]
+
+def scan_path_dir(directory):
+    """ Map executable names to paths in directory, cached until its mtime changes """
+    cached = path_dir_cache.get(directory)
+    if cached and path_watcher and directory in path_watcher.directories:
+        # inotify invalidates watched listings, so they need no stat
+        return cached[1]
+
+    if path_watcher:
+        path_watcher.watch(directory)
+
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        path_dir_cache.pop(directory, None)
+        return {}
+
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    path_stats['directory scans'] += 1
+    entries = {}
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_file() and os.access(entry.path, os.X_OK):
+                        entries[entry.name] = entry.path
+                except OSError:
+                    continue
+    except (OSError, PermissionError):
+        pass
+
+    path_dir_cache[directory] = (mtime, entries, next(path_dir_generation))
+    return entries
+
+def get_executables_in_path(scan=True):
+    """ Names of all PATH executables; with scan=False only directories that
+    are already cached are used, so the result may be partial """
+    global path_executables
+
+    dirs = get_path_dirs()
+    if scan:
+        for d in dirs:
+            scan_path_dir(d)
+
+    listings = [path_dir_cache.get(d) for d in dirs]
+    key = tuple(listing[2] for listing in listings if listing)
+    if path_executables[0] != key:
+        path_stats['index builds'] += 1
+        executables = set()
+        for listing in listings:
+            if listing:
+                executables.update(listing[1])
+        path_executables = (key, list(executables))
+
+    return path_executables[1]
+
+class PathWatcher:
+    """ inotify watches on PATH directories that drop their cached listings
+    (and stale hash table entries) as soon as anything in them changes """
+
+    IN_ATTRIB = 0x004
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_IGNORED = 0x8000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        import ctypes
+
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.lock = threading.Lock()
+        self.directories = set()
+        self.watches = {}
+
+    def watch(self, directory):
+        with self.lock:
+            if directory in self.directories:
+                return
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+            if wd >= 0:
+                self.watches[wd] = directory
+                self.directories.add(directory)
+
+    def run(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError:
+                return
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b'\0')
+                offset += self.EVENT.size + length
+
+                directory = self.watches.get(wd)
+                if directory is None:
+                    continue
+                path_dir_cache.pop(directory, None)
+                if name:
+                    hashed_commands.pop(os.fsdecode(name), None)
+                if mask & (self.IN_IGNORED | self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                    with self.lock:
+                        self.watches.pop(wd, None)
+                        self.directories.discard(directory)
+
+def warm_command_index():
+    """ Fill the PATH listings and completion index off the prompt's critical path """
+    global path_watcher
+
+    try:
+        if sys.platform.startswith('linux'):
+            try:
+                path_watcher = PathWatcher()
+            except (OSError, AttributeError):
+                path_watcher = None
+            else:
+                threading.Thread(target=path_watcher.run, daemon=True).start()
+        get_command_names()
+    finally:
+        path_index_warming.clear()
+
+def forget_threads_after_fork():
+    """ Drop what the shell's threads own in a forked copy of it: the
+    threads don't exist there, and a lock they held would stay held """
+    global path_watcher, history_index
+
+    # unwatched directories fall back to mtime checks
+    path_watcher = None
+    # history -s then searches the list
+    history_index = None
+
+os.register_at_fork(after_in_child=forget_threads_after_fork)
+
+def find_executable(command):
+    if '/' in command:
+        if os.path.isfile(command) and os.access(command, os.X_OK):
+            return command
+        return None
+
+    dirs = get_path_dirs()
+    entry = hashed_commands.get(command)
+    if entry:
+        if os.access(entry[0], os.X_OK):
+            entry[1] += 1
+            path_stats['hash hits'] += 1
+            return entry[0]
+        del hashed_commands[command]
+
+    path_stats['hash misses'] += 1
+    for d in dirs:
+        candidate = scan_path_dir(d).get(command)
+        if candidate:
+            hashed_commands[command] = [candidate, 1]
+            return candidate
+
+    return None
+
+def env_limit(name, default=None):
+    """ Read a non-negative integer setting such as HISTSIZE from the environment """
+    try:
+        value = int(os.environ[name])
+    except (KeyError, ValueError):
+        return default
+    return value if value >= 0 else default
+
+def trim_history():
+    limit = env_limit('HISTSIZE')
+    if limit is not None:
+        history.trim(limit)
+
+def ensure_history_loaded():
+    """ Build the history list from the lines readline loaded at startup
+
+    Startup only hands $HISTFILE to readline.read_history_file; the Python
+    list is filled from readline the first time something needs it.
+    """
+    global history_pending
+
+    if history_pending:
+        count, history_pending = history_pending, 0
+        get_item = readline.get_history_item
+        loaded = (get_item(i) for i in range(1, count + 1))
+        history.prepend(line.strip() for line in loaded if line and line.strip())
+        trim_history()
+
+def add_to_history(lines):
+    """ Append lines to the history list and readline, honouring HISTSIZE """
+    ensure_history_loaded()
+    history.extend(lines)
+    if readline:
+        for line in lines:
+            readline.add_history(line)
+    trim_history()
+
+def read_history_lines(path):
+    """ Read a history file with a single read """
+    with open(path, 'r') as f:
+        data = f.read()
+    return [line.strip() for line in data.splitlines() if line.strip()]
+
+class HistoryList:
+    """ The session's history: one bytes buffer with an offset per entry
+
+    Every entry is stored newline-terminated, so entry N is a single slice
+    and -w/-a write ranges of the buffer as they are. Trimming to HISTSIZE
+    only advances `first`; the dead prefix is cut off once it outweighs the
+    live part. erasedups keeps a hash -> count index so a line with no
+    earlier copy costs a dict lookup rather than a scan.
+    """
+
+    BLOCK_ENTRIES = 4096
+
+    def __init__(self, lines=()):
+        self.buffer = bytearray()
+        # offsets[i] is where entry i starts; the last one is the buffer's end
+        self.offsets = array('Q', (0,))
+        self.first = 0
+        # entries trimmed or erased so far, so history -a positions survive
+        self.removed = 0
+        self.counts = None
+        self.extend(lines)
+
+    def __len__(self):
+        return len(self.offsets) - 1 - self.first
+
+    def entry(self, i):
+        return self.buffer[self.offsets[i]:self.offsets[i + 1] - 1].decode(errors='surrogateescape')
+
+    def __getitem__(self, index):
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("history index out of range")
+        return self.entry(self.first + index)
+
+    def lines(self, start=0):
+        """ Yield entries from the start'th on, decoding a block at a time """
+        offsets = self.offsets
+        i = self.first + max(start, 0)
+        end = len(offsets) - 1
+        while i < end:
+            stop = min(i + self.BLOCK_ENTRIES, end)
+            block = self.buffer[offsets[i]:offsets[stop]].decode(errors='surrogateescape')
+            entries = block.split('\n')
+            if len(entries) == stop - i + 1:
+                yield from entries[:-1]
+            else:
+                # some entry spans lines, so the split doesn't line up
+                for j in range(i, stop):
+                    yield self.entry(j)
+            i = stop
+
+    def __iter__(self):
+        return self.lines()
+
+    def __reversed__(self):
+        for i in range(len(self.offsets) - 2, self.first - 1, -1):
+            yield self.entry(i)
+
+    def append(self, line):
+        self.buffer += line.encode(errors='surrogateescape')
+        self.buffer += b'\n'
+        self.offsets.append(len(self.buffer))
+        if self.counts is not None:
+            key = hash(line)
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def prepend(self, lines):
+        older = HistoryList(lines)
+        start = self.offsets[self.first]
+        base = len(older.buffer)
+        older.buffer += memoryview(self.buffer)[start:]
+        older.offsets.extend(offset - start + base for offset in self.offsets[self.first + 1:])
+        self.buffer, self.offsets, self.first = older.buffer, older.offsets, 0
+        self.counts = None
+
+    def add(self, line, control=()):
+        """ Append line unless HISTCONTROL's ignore rules drop it; return
+        whether it was kept """
+        if line[:1] == ' ' and ('ignorespace' in control or 'ignoreboth' in control):
+            return False
+        if len(self) and ('ignoredups' in control or 'ignoreboth' in control) and self[-1] == line:
+            return False
+        if 'erasedups' in control:
+            if self.counts is None:
+                self.counts = {}
+                for entry in self:
+                    key = hash(entry)
+                    self.counts[key] = self.counts.get(key, 0) + 1
+            if self.counts.get(hash(line)):
+                self.erase(line)
+        self.append(line)
+        return True
+
+    def erase(self, line):
+        """ Remove every entry equal to line """
+        data = line.encode(errors='surrogateescape') + b'\n'
+        offsets = self.offsets
+        pos = self.buffer.find(data, offsets[self.first])
+        while pos != -1:
+            i = bisect_left(offsets, pos, self.first, len(offsets) - 1)
+            if offsets[i] != pos or offsets[i + 1] != pos + len(data):
+                # a match that doesn't line up with a whole entry
+                pos = self.buffer.find(data, pos + 1)
+                continue
+            del self.buffer[pos:pos + len(data)]
+            offsets[i:] = array('Q', (offset - len(data) for offset in offsets[i + 1:]))
+            self.removed += 1
+            if readline and readline.get_current_history_length() == len(self) + 1:
+                # keep up-arrow in step when readline mirrors the list
+                readline.remove_history_item(i - self.first)
+            pos = self.buffer.find(data, pos)
+        if self.counts is not None:
+            self.counts.pop(hash(line), None)
+
+    def trim(self, limit):
+        """ Drop the oldest entries beyond limit """
+        excess = len(self) - limit
+        if excess <= 0:
+            return
+        if self.counts is not None:
+            for i in range(self.first, self.first + excess):
+                key = hash(self.entry(i))
+                self.counts[key] -= 1
+        self.first += excess
+        self.removed += excess
+        if self.offsets[self.first] > len(self.buffer) - self.offsets[self.first]:
+            start = self.offsets[self.first]
+            del self.buffer[:start]
+            self.offsets = array('Q', (offset - start for offset in self.offsets[self.first:]))
+            self.first = 0
+
+    def write(self, f, start=0):
+        """ Write entries from the start'th on to binary file f, one per line """
+        start = min(self.first + max(start, 0), len(self.offsets) - 1)
+        f.write(memoryview(self.buffer)[self.offsets[start]:])
+
+    def search(self, pattern):
+        """ Yield (line number, line) for entries containing pattern """
+        data = pattern.encode(errors='surrogateescape')
+        offsets = self.offsets
+        pos = self.buffer.find(data, offsets[self.first])
+        while pos != -1:
+            i = bisect_right(offsets, pos, self.first, len(offsets) - 1) - 1
+            yield i - self.first + 1, self.entry(i)
+            pos = self.buffer.find(data, offsets[i + 1])
+
+history = HistoryList()
+
+class HistoryFile:
+    """ Buffered append handle on $HISTFILE: lines reach the file at most
+    flush_interval seconds after they're added, even if the shell sits idle """
+
+    def __init__(self, path, flush_interval=5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.lines_in_file = 0
+        self.after_fork()
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def after_fork(self):
+        # a forked copy of the shell leaves the buffered lines to the parent
+        self.lock = threading.RLock()
+        self.pending = []
+        self.timer = None
+
+    def load(self):
+        """ Read the file once, straight into readline """
+        global history_pending
+
+        if not os.path.exists(self.path):
+            return
+        readline.read_history_file(self.path)
+        history_pending = self.lines_in_file = readline.get_current_history_length()
+
+    def append(self, line):
+        with self.lock:
+            self.pending.append(line + "\n")
+            self.lines_in_file += 1
+            if self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self.flush_later)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.pending:
+                return
+            with open(self.path, 'a', errors='surrogateescape') as f:
+                f.write(''.join(self.pending))
+            self.pending.clear()
+        if history_index:
+            history_index.update()
+
+    def flush_later(self):
+        try:
+            self.flush()
+        except OSError as e:
+            print(f"Failed to write to history file {self.path}: {e.strerror}", file=sys.stderr)
+
+    def compact(self, limit):
+        """ Rewrite the file keeping only its last limit lines """
+        lines = read_history_lines(self.path)[-limit:] if limit else []
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(''.join(line + "\n" for line in lines))
+        os.replace(tmp_path, self.path)
+        self.lines_in_file = len(lines)
+
+    def close(self):
+        self.flush()
+
+        limit = env_limit('HISTFILESIZE', env_limit('HISTSIZE'))
+        if limit is not None and self.lines_in_file > limit:
+            self.compact(limit)
+
+class HistoryIndex:
+    """ Substring search over a memory-mapped history file
+
+    Lines are grouped into blocks of BLOCK_LINES; a trigram -> block ids index
+    narrows a search to the few blocks that can match, which are then scanned
+    with mmap.find. The index only ever grows from the last indexed byte, so
+    appends cost nothing until the next flush or search.
+    """
+
+    BLOCK_LINES = 256
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.map = None
+        self.reset()
+
+    def reset(self):
+        self.indexed_size = 0
+        self.line_offsets = array('Q')
+        self.postings = {}
+        self.open_block_trigrams = set()
+
+    def remap(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size < self.indexed_size:
+            # the file was rewritten (compaction, history -w); start over
+            self.reset()
+        if self.map is not None and len(self.map) == size:
+            return
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if size:
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def update(self):
+        """ Index whole lines appended since the last update """
+        with self.lock:
+            self.remap()
+            if self.map is None:
+                return
+
+            end = self.map.rfind(b'\n', self.indexed_size) + 1
+            if end == 0:
+                return
+            offset = self.indexed_size
+            while offset < end:
+                line_number = len(self.line_offsets)
+                block = line_number // self.BLOCK_LINES
+                if line_number % self.BLOCK_LINES == 0:
+                    self.open_block_trigrams = set()
+
+                # index the rest of this block in one go
+                block_end = offset
+                for _ in range(self.BLOCK_LINES - line_number % self.BLOCK_LINES):
+                    if block_end >= end:
+                        break
+                    self.line_offsets.append(block_end)
+                    block_end = self.map.find(b'\n', block_end, end) + 1
+
+                chunk = self.map[offset:block_end]
+                trigrams = set(zip(chunk, chunk[1:], chunk[2:]))
+                trigrams -= self.open_block_trigrams
+                self.open_block_trigrams |= trigrams
+                for trigram in trigrams:
+                    blocks = self.postings.get(trigram)
+                    if blocks is None:
+                        self.postings[trigram] = array('I', (block,))
+                    else:
+                        blocks.append(block)
+
+                offset = block_end
+
+            self.indexed_size = end
+
+    def __len__(self):
+        return len(self.line_offsets)
+
+    def line(self, line_number):
+        """ The indexed line at line_number, counting from 1 """
+        with self.lock:
+            start = self.line_offsets[line_number - 1]
+            return self.map[start:self.map.find(b'\n', start)].decode(errors='replace')
+
+    def candidate_blocks(self, pattern):
+        block_count = (len(self.line_offsets) + self.BLOCK_LINES - 1) // self.BLOCK_LINES
+        if len(pattern) < 3:
+            return range(block_count)
+
+        postings = []
+        for trigram in set(zip(pattern, pattern[1:], pattern[2:])):
+            blocks = self.postings.get(trigram)
+            if blocks is None:
+                return []
+            postings.append(blocks)
+
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for blocks in postings[1:]:
+            candidates.intersection_update(blocks)
+            if not candidates:
+                break
+        return sorted(candidates)
+
+    def search(self, pattern):
+        """ Yield (line number, line) for every indexed line containing pattern """
+        self.update()
+        pattern = pattern.encode()
+
+        with self.lock:
+            if self.map is None:
+                return
+            offsets = self.line_offsets
+            for block in self.candidate_blocks(pattern):
+                first = block * self.BLOCK_LINES
+                start = offsets[first]
+                if first + self.BLOCK_LINES < len(offsets):
+                    end = offsets[first + self.BLOCK_LINES]
+                else:
+                    end = self.indexed_size
+
+                pos = self.map.find(pattern, start, end)
+                while pos != -1:
+                    last = min(first + self.BLOCK_LINES, len(offsets))
+                    line_number = bisect_right(offsets, pos, first, last) - 1
+                    line_start = offsets[line_number]
+                    line_end = self.map.find(b'\n', pos, end)
+                    yield line_number + 1, self.map[line_start:line_end].decode(errors='replace')
+                    pos = self.map.find(pattern, line_end + 1, end)
+
+class ShellSyntaxError(Exception):
+    pass
+
+class IncompleteCommand(ShellSyntaxError):
+    """ The input stops inside a compound command or after |, && or || """
+
+UNCOMPILED = object()
+
+class Word:
+    """ A shell word as (text, quote) parts; quote is None, "'", '"' or '\\',
+    or for an expansion its opener ('$', '$(' or '$((', after a '"' inside
+    double quotes) with text holding its source """
+    __slots__ = ('parts', 'plan')
+
+    def __init__(self, parts):
+        self.parts = parts
+        # expansion steps, compiled on first use and kept with the cached parse
+        self.plan = UNCOMPILED
+
+    @property
+    def text(self):
+        return ''.join(text for text, _ in self.parts)
+
+class Redirection:
+    __slots__ = ('fd', 'op', 'target')
+
+    def __init__(self, fd, op, target):
+        self.fd = fd
+        self.op = op
+        self.target = target
+
+class Command:
+    __slots__ = ('words', 'redirects', 'assignments', 'plain')
+
+    def __init__(self, words=None, redirects=None, assignments=None):
+        self.words = words if words is not None else []
+        self.redirects = redirects if redirects is not None else []
+        # leading NAME=value words
+        self.assignments = assignments if assignments is not None else []
+        # whether nothing in words or redirects expands, once known
+        self.plain = None
+
+    @property
+    def argv(self):
+        return [word.text for word in self.words]
+
+class Pipeline:
+    __slots__ = ('commands', 'background', 'connector', 'negate')
+
+    def __init__(self, commands=None, background=False):
+        self.commands = commands if commands is not None else []
+        self.background = background
+        # '&&' or '||' when the previous pipeline's status decides whether this runs
+        self.connector = None
+        self.negate = False
+
+class If:
+    __slots__ = ('clauses', 'else_body', 'redirects')
+
+    def __init__(self, clauses, else_body=None):
+        # (condition, body) pairs for the if and each elif
+        self.clauses = clauses
+        self.else_body = else_body
+        self.redirects = []
+
+class Loop:
+    """ while or until, by keyword """
+    __slots__ = ('keyword', 'condition', 'body', 'redirects')
+
+    def __init__(self, keyword, condition, body):
+        self.keyword = keyword
+        self.condition = condition
+        self.body = body
+        self.redirects = []
+
+class For:
+    __slots__ = ('name', 'words', 'body', 'redirects')
+
+    def __init__(self, name, words, body):
+        self.name = name
+        # None loops over the positional parameters
+        self.words = words
+        self.body = body
+        self.redirects = []
+
+class Group:
+    __slots__ = ('body', 'redirects')
+
+    def __init__(self, body):
+        self.body = body
+        self.redirects = []
+
+class FunctionDefinition:
+    __slots__ = ('name', 'body')
+
+    def __init__(self, name, body):
+        self.name = name
+        self.body = body
+
+# runs of characters that need no special handling, consumed a chunk at a time
+PLAIN_RUN = re.compile(r"[^\s'\"\\|<>&$;()]+")
+DOUBLE_QUOTED_RUN = re.compile(r'[^"\\$]+')
+PARAMETER_NAME = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|[0-9?$!#@*]')
+ASSIGNMENT_WORD = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)=')
+DOUBLE_QUOTE_ESCAPES = '\\"$`'
+# longest first, so the lexer takes `<<<` over `<` and `>>` over `>`
+REDIRECTION_OPERATORS = ('<<<', '>>', '>&', '<&', '>', '<')
+REDIRECTION_TOKENS = frozenset(REDIRECTION_OPERATORS + ('&>', '&>>'))
+RESERVED_WORDS = frozenset((
+    'if', 'then', 'elif', 'else', 'fi', 'for', 'in', 'do', 'done',
+    'while', 'until', '{', '}', '!', 'function'
+))
+
+def closing_bracket(input_line, i, close):
+    """ Index of the bracket closing the one at input_line[i], skipping quoted text """
+    opener = input_line[i]
+    depth = 0
+    n = len(input_line)
+
+    while i < n:
+        char = input_line[i]
+        if char == '\\':
+            i += 2
+            continue
+        if char == "'":
+            end = input_line.find("'", i + 1)
+            if end == -1:
+                break
+            i = end
+        elif char == '"':
+            i += 1
+            while i < n and input_line[i] != '"':
+                i += 2 if input_line[i] == '\\' else 1
+        elif char == opener:
+            depth += 1
+        elif char == close:
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+
+    raise ShellSyntaxError(f"unexpected EOF while looking for matching `{close}'")
+
+def read_expansion(input_line, i):
+    """ Read the expansion whose $ is at input_line[i]
+
+    Returns (source, opener, end); opener is None for a $ that starts
+    nothing and so stands for itself.
+    """
+    next_char = input_line[i+1:i+2]
+    if next_char == '(':
+        end = closing_bracket(input_line, i + 1, ')') + 1
+        if (input_line.startswith('((', i + 1) and input_line[end-2] == ')'
+                and closing_bracket(input_line, i + 2, ')') == end - 2):
+            return input_line[i:end], '$((', end
+        return input_line[i:end], '$(', end
+    if next_char == '{':
+        end = closing_bracket(input_line, i + 1, '}') + 1
+        return input_line[i:end], '$', end
+
+    match = PARAMETER_NAME.match(input_line, i + 1)
+    if match is None:
+        return '$', None, i + 1
+    return input_line[i:match.end()], '$', match.end()
+
+def tokenize(input_line):
+    """ Split input_line into Word and operator tokens in one linear pass """
+    tokens = []
+    parts = []
+    n = len(input_line)
+    i = 0
+
+    while i < n:
+        char = input_line[i]
+
+        if char == "'":
+            end = input_line.find("'", i + 1)
+            if end == -1:
+                # the quote may close on a later line
+                raise IncompleteCommand("syntax error: unexpected end of file while looking for matching `''")
+            parts.append((input_line[i+1:end], "'"))
+            i = end + 1
+        elif char == '"':
+            chunks = []
+            first_part = len(parts)
+            i += 1
+            while i < n and input_line[i] != '"':
+                if input_line[i] == '\\':
+                    if i + 1 < n and input_line[i+1] in DOUBLE_QUOTE_ESCAPES:
+                        chunks.append(input_line[i+1])
+                        i += 2
+                    else:
+                        chunks.append('\\')
+                        i += 1
+                elif input_line[i] == '$':
+                    source, opener, i = read_expansion(input_line, i)
+                    if opener is None:
+                        chunks.append(source)
+                        continue
+                    if chunks:
+                        parts.append((''.join(chunks), '"'))
+                        chunks = []
+                    parts.append((source, '"' + opener))
+                else:
+                    match = DOUBLE_QUOTED_RUN.match(input_line, i)
+                    chunks.append(match.group())
+                    i = match.end()
+            if i >= n:
+                raise IncompleteCommand("syntax error: unexpected end of file while looking for matching `\"'")
+            if chunks or len(parts) == first_part:
+                parts.append((''.join(chunks), '"'))
+            i += 1
+        elif char == '\\':
+            # backslash-newline joins lines and leaves nothing behind
+            if i + 1 == n:
+                raise IncompleteCommand("syntax error: unexpected end of file")
+            if input_line[i+1] != '\n':
+                parts.append((input_line[i+1], '\\'))
+            i += 2
+        elif char == '#' and not parts:
+            end = input_line.find('\n', i)
+            i = n if end == -1 else end
+        elif char in '|&;()\n' and not input_line.startswith('&>', i):
+            if parts:
+                tokens.append(Word(parts))
+                parts = []
+            if char in '|&' and input_line.startswith(char * 2, i):
+                tokens.append((char * 2, None))
+                i += 2
+            else:
+                tokens.append((char, None))
+                i += 1
+        elif char.isspace():
+            if parts:
+                tokens.append(Word(parts))
+                parts = []
+            i += 1
+        elif char == '&' and input_line.startswith('&>', i):
+            if parts:
+                tokens.append(Word(parts))
+                parts = []
+            if input_line.startswith('&>>', i):
+                tokens.append(('&>>', None))
+                i += 3
+            else:
+                tokens.append(('&>', None))
+                i += 2
+        elif char in '<>':
+            # a bare number directly before the operator names the fd, as in 2>
+            fd = None
+            if len(parts) == 1 and parts[0][1] is None and parts[0][0].isdigit():
+                fd = int(parts[0][0])
+                parts = []
+            elif parts:
+                tokens.append(Word(parts))
+                parts = []
+
+            for op in REDIRECTION_OPERATORS:
+                if input_line.startswith(op, i):
+                    tokens.append((op, fd))
+                    i += len(op)
+                    break
+        elif char == '$':
+            source, opener, i = read_expansion(input_line, i)
+            parts.append((source, opener))
+        else:
+            match = PLAIN_RUN.match(input_line, i)
+            parts.append((match.group(), None))
+            i = match.end()
+
+    if parts:
+        tokens.append(Word(parts))
+
+    return tokens
+
+def plain_word(token):
+    """ The text of an unquoted, unexpanded word token, else None """
+    if isinstance(token, Word) and len(token.parts) == 1 and token.parts[0][1] is None:
+        return token.parts[0][0]
+    return None
+
+class Parser:
+    """ Recursive descent over tokenize() output
+
+    A list is a sequence of Pipelines joined by ;, &, && and || or
+    newlines; compound commands hold lists of their own.
+    """
+    def __init__(self, tokens):
+        # a trailing None marks the end, so peek needs no bounds check
+        self.tokens = tokens
+        tokens.append(None)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position]
+
+    def keyword(self):
+        """ The reserved word at the current position, if it is one """
+        word = plain_word(self.peek())
+        return word if word in RESERVED_WORDS else None
+
+    def unexpected(self):
+        token = self.peek()
+        if token is None:
+            return IncompleteCommand("syntax error: unexpected end of file")
+        text = token.text if isinstance(token, Word) else token[0]
+        if text == '\n':
+            text = 'newline'
+        return ShellSyntaxError(f"syntax error near unexpected token `{text}'")
+
+    def expect(self, keyword):
+        if self.keyword() != keyword:
+            raise self.unexpected()
+        self.position += 1
+
+    def skip_newlines(self):
+        while self.peek() == ('\n', None):
+            self.position += 1
+
+    def parse(self):
+        pipelines = self.parse_list()
+        if self.peek() is not None:
+            raise self.unexpected()
+        return pipelines
+
+    def parse_list(self, terminators=()):
+        """ Pipelines up to one of the terminators reserved words, or the end of input """
+        pipelines = []
+        connector = None
+
+        while True:
+            self.skip_newlines()
+            token = self.peek()
+            if token is None:
+                if connector or terminators:
+                    raise self.unexpected()
+                return pipelines
+            if terminators and self.keyword() in terminators:
+                if connector or not pipelines:
+                    raise self.unexpected()
+                return pipelines
+
+            pipeline = self.parse_pipeline()
+            pipeline.connector = connector
+            pipelines.append(pipeline)
+            connector = None
+
+            token = self.peek()
+            if token is None:
+                continue
+            if isinstance(token, Word) or token[0] not in (';', '\n', '&', '&&', '||'):
+                raise self.unexpected()
+            self.position += 1
+            if token[0] == '&':
+                pipeline.background = True
+            elif token[0] != ';' and token[0] != '\n':
+                connector = token[0]
+
+    def parse_pipeline(self):
+        pipeline = Pipeline()
+        if self.keyword() == '!':
+            self.position += 1
+            pipeline.negate = True
+
+        while True:
+            pipeline.commands.append(self.parse_command())
+            if self.peek() != ('|', None):
+                return pipeline
+            self.position += 1
+            self.skip_newlines()
+
+    def parse_command(self, expanded_aliases=frozenset()):
+        word = plain_word(self.peek())
+        if word in aliases and word not in expanded_aliases:
+            # aliases are replaced as text before the command is parsed
+            self.tokens[self.position:self.position + 1] = tokenize(aliases[word])
+            return self.parse_command(expanded_aliases | {word})
+
+        match word if word in RESERVED_WORDS else None:
+            case 'if':
+                node = self.parse_if()
+            case 'while' | 'until':
+                node = self.parse_loop()
+            case 'for':
+                node = self.parse_for()
+            case '{':
+                node = self.parse_group()
+            case 'function':
+                self.position += 1
+                return self.parse_function()
+            case None:
+                following = self.tokens[self.position + 1:self.position + 3]
+                if word is not None and following == [('(', None), (')', None)]:
+                    return self.parse_function()
+                return self.parse_simple_command()
+            case _:
+                raise self.unexpected()
+
+        self.parse_redirects(node.redirects)
+        return node
+
+    def parse_redirects(self, redirects):
+        while True:
+            token = self.peek()
+            if isinstance(token, Word) or token is None or token[0] not in REDIRECTION_TOKENS:
+                return
+            op, fd = token
+            self.position += 1
+            target = self.peek()
+            if not isinstance(target, Word):
+                if target is None or target == ('\n', None):
+                    raise ShellSyntaxError("syntax error near unexpected token `newline'")
+                raise ShellSyntaxError(f"syntax error near unexpected token `{target[0]}'")
+            if fd is None:
+                fd = 0 if op[0] == '<' else 1
+            redirects.append(Redirection(fd, op, target))
+            self.position += 1
+
+    def parse_simple_command(self):
+        command = Command()
+        words = command.words
+        tokens = self.tokens
+
+        while True:
+            token = tokens[self.position]
+            if type(token) is Word:
+                if (not words and token.parts[0][1] is None
+                        and ASSIGNMENT_WORD.match(token.parts[0][0])):
+                    command.assignments.append(token)
+                else:
+                    words.append(token)
+                self.position += 1
+            elif token is not None and token[0] in REDIRECTION_TOKENS:
+                self.parse_redirects(command.redirects)
+            else:
+                break
+
+        if not command.words and not command.redirects and not command.assignments:
+            raise self.unexpected()
+        return command
+
+    def parse_if(self):
+        self.expect('if')
+        clauses = []
+        else_body = None
+
+        keyword = 'if'
+        while keyword in ('if', 'elif'):
+            condition = self.parse_list(('then',))
+            self.expect('then')
+            clauses.append((condition, self.parse_list(('elif', 'else', 'fi'))))
+            keyword = self.keyword()
+            self.position += 1
+        if keyword == 'else':
+            else_body = self.parse_list(('fi',))
+            self.expect('fi')
+
+        return If(clauses, else_body)
+
+    def parse_loop(self):
+        keyword = self.keyword()
+        self.position += 1
+        condition = self.parse_list(('do',))
+        self.expect('do')
+        body = self.parse_list(('done',))
+        self.expect('done')
+        return Loop(keyword, condition, body)
+
+    def parse_for(self):
+        self.expect('for')
+        name = plain_word(self.peek())
+        if name is None or not ASSIGNMENT_WORD.fullmatch(name + '='):
+            raise self.unexpected()
+        self.position += 1
+
+        words = None
+        self.skip_newlines()
+        if self.keyword() == 'in':
+            self.position += 1
+            words = []
+            while isinstance(self.peek(), Word):
+                words.append(self.peek())
+                self.position += 1
+            if self.peek() not in ((';', None), ('\n', None)):
+                raise self.unexpected()
+            self.position += 1
+        elif self.peek() == (';', None):
+            self.position += 1
+        self.skip_newlines()
+
+        self.expect('do')
+        body = self.parse_list(('done',))
+        self.expect('done')
+        return For(name, words, body)
+
+    def parse_group(self):
+        self.expect('{')
+        body = self.parse_list(('}',))
+        self.expect('}')
+        return Group(body)
+
+    def parse_function(self):
+        token = self.peek()
+        if not isinstance(token, Word):
+            raise self.unexpected()
+        name = token.text
+        self.position += 1
+        if self.tokens[self.position:self.position + 2] == [('(', None), (')', None)]:
+            self.position += 2
+        self.skip_newlines()
+
+        if self.keyword() not in ('{', 'if', 'while', 'until', 'for'):
+            raise self.unexpected()
+        return FunctionDefinition(name, self.parse_command())
+
+def parse_line(input_line):
+    """ Parse input_line into a list of Pipelines """
+    return Parser(tokenize(input_line)).parse()
+
+def parse_cached(input_line):
+    """ parse_line through a bounded LRU cache keyed by the raw line """
+    pipelines = parse_cache.get(input_line)
+    if pipelines is not None:
+        parse_cache.move_to_end(input_line)
+        parse_cache_stats['hits'] += 1
+        return pipelines
+
+    parse_cache_stats['misses'] += 1
+    pipelines = parse_line(input_line)
+    parse_cache[input_line] = pipelines
+    if len(parse_cache) > PARSE_CACHE_SIZE:
+        parse_cache.popitem(last=False)
+
+    return pipelines
+
+HISTORY_EVENT = re.compile(r"!(!|-?\d+|[^\s!=()'\"|<>]+)")
+SINGLE_QUOTED = re.compile(r"('[^']*')")
+
+def lookup_history_event(designator):
+    if designator == '!':
+        designator = '-1'
+
+    try:
+        index = int(designator)
+    except ValueError:
+        for line in reversed(history):
+            if line.startswith(designator):
+                return line
+        return None
+
+    if index > 0 and index <= len(history):
+        return history[index - 1]
+    if index < 0 and -index <= len(history):
+        return history[index]
+    return None
+
+def expand_history(input_line):
+    """ Expand !!, !n, !-n and !prefix outside single quotes """
+    if '!' not in input_line:
+        return input_line
+    ensure_history_loaded()
+
+    def replace(match):
+        line = lookup_history_event(match.group(1))
+        if line is None:
+            raise ShellSyntaxError(f"{match.group()}: event not found")
+        return line
+
+    pieces = SINGLE_QUOTED.split(input_line)
+    for i in range(0, len(pieces), 2):
+        pieces[i] = HISTORY_EVENT.sub(replace, pieces[i])
+
+    return ''.join(pieces)
+
+class ExpansionError(Exception):
+    pass
+
+GLOB_MAGIC = re.compile(r'[*?[]')
+PARAMETER_EXPRESSION = re.compile(r'(#?)([A-Za-z_][A-Za-z0-9_]*|[0-9]+|[?$!#@*])(?:(:?[-=+?])(.*))?', re.S)
+ARITHMETIC_TOKEN = re.compile(r'\s*(?:(\w+)|(\*\*|<<|>>|<=|>=|==|!=|&&|\|\||[-+*/%<>&|^!~()]))')
+
+def compile_expansion(source, opener, quoted):
+    """ One expansion step for the $-expression source """
+    if opener == '$((':
+        return ('arith', compile_text(source[3:-2]), quoted)
+    if opener == '$(':
+        return ('cmd', source[2:-1], quoted)
+
+    if source.startswith('${'):
+        match = PARAMETER_EXPRESSION.fullmatch(source, 2, len(source) - 1)
+        if match is None or (match.group(1) and match.group(3)):
+            raise ExpansionError(f"{source}: bad substitution")
+        length, name, op, operand = match.groups()
+        return ('param', (bool(length), name, op, compile_text(operand or '')), quoted)
+    return ('param', (False, source[1:], None, None), quoted)
+
+def compile_text(text):
+    """ Expansion steps for text that is expanded but never split or globbed,
+    such as ${VAR:-word} operands and $(( )) bodies """
+    steps = []
+    start = i = 0
+    while (i := text.find('$', i)) != -1:
+        source, opener, end = read_expansion(text, i)
+        if opener is not None:
+            if i > start:
+                steps.append(('lit', text[start:i], True))
+            steps.append(compile_expansion(source, opener, True))
+            start = end
+        i = end
+    if start < len(text):
+        steps.append(('lit', text[start:], True))
+    return steps
+
+def compile_word(parts):
+    """ Compile a word's parts into expansion steps, or None for plain text """
+    steps = []
+    plain = True
+
+    for index, (text, quote) in enumerate(parts):
+        if quote is None:
+            if index == 0 and text[:1] == '~':
+                prefix, slash, text = text.partition('/')
+                steps.append(('tilde', prefix, True))
+                text = slash + text
+                plain = False
+            if GLOB_MAGIC.search(text):
+                plain = False
+            steps.append(('lit', text, False))
+        elif quote in ("'", '"', '\\'):
+            steps.append(('lit', text, True))
+        else:
+            plain = False
+            quoted = quote[0] == '"'
+            steps.append(compile_expansion(text, quote.lstrip('"'), quoted))
+
+    return None if plain else steps
+
+def word_plan(word):
+    plan = word.plan
+    if plan is UNCOMPILED:
+        try:
+            plan = word.plan = compile_word(word.parts)
+        except ShellSyntaxError as e:
+            raise ExpansionError(str(e))
+    return plan
+
+def parameter_value(name):
+    """ The value of a shell parameter, None when unset """
+    if name in shell_variables:
+        return shell_variables[name]
+    if name in os.environ:
+        return os.environ[name]
+
+    match name:
+        case '?':
+            return str(last_exit_status)
+        case '$':
+            return str(os.getpid())
+        case '!':
+            return None if last_background_pid is None else str(last_background_pid)
+        case '#':
+            return str(len(positional_parameters) - 1)
+        case '@' | '*':
+            return ' '.join(positional_parameters[1:])
+    if name.isdigit() and int(name) < len(positional_parameters):
+        return positional_parameters[int(name)]
+    return None
+
+def set_variable(name, value):
+    """ Assign a shell variable, updating the environment when it is exported """
+    if name in os.environ:
+        os.environ[name] = value
+        environment_changed()
+    else:
+        shell_variables[name] = value
+
+def expand_parameter(length, name, op, operand):
+    value = parameter_value(name)
+
+    if op:
+        unset = value is None or (op[0] == ':' and not value)
+        match op[-1]:
+            case '-':
+                if unset:
+                    value = expand_text(operand)
+            case '=':
+                if unset:
+                    if not name[0].isalpha() and name[0] != '_':
+                        raise ExpansionError(f"${name}: cannot assign in this way")
+                    value = expand_text(operand)
+                    set_variable(name, value)
+            case '+':
+                value = '' if unset else expand_text(operand)
+            case '?':
+                if unset:
+                    raise ExpansionError(f"{name}: {expand_text(operand) or 'parameter null or not set'}")
+
+    if value is None:
+        value = ''
+    return str(len(value)) if length else value
+
+def command_substitution(source):
+    """ Run source in a forked copy of the shell and return its output
+
+    The output is read from a pipe as the child writes it, and the child's
+    exit status becomes $?. Bytes that aren't UTF-8 survive as surrogate
+    escapes, so they reach argv and files unchanged; NULs can't be in an
+    argument and are dropped, as bash does.
+    """
+    global last_exit_status, substitution_status
+
+    try:
+        pipelines = parse_cached(source)
+    except ShellSyntaxError:
+        # the copy reports it
+        pipelines = None
+    if pipelines and len(pipelines) == 1 and cache_prefixed(pipelines[0]) and not pipelines[0].negate:
+        data = run_cached(pipelines[0], capture=True)
+        substitution_status = last_exit_status
+        return os.fsdecode(data.replace(b'\0', b'')).rstrip('\n')
+
+    read_fd, write_fd = os.pipe()
+    try:
+        process = fork_shell({0: 0, 1: write_fd, 2: 2}, None, run_line, source)
+    finally:
+        os.close(write_fd)
+
+    chunks = []
+    try:
+        while chunk := os.read(read_fd, SCRIPT_OUTPUT_BUFFER):
+            chunks.append(chunk)
+    finally:
+        os.close(read_fd)
+        _, status = os.waitpid(process.pid, 0)
+        last_exit_status = substitution_status = os.waitstatus_to_exitcode(status)
+
+    return os.fsdecode(b''.join(chunks).replace(b'\0', b'')).rstrip('\n')
+
+def c_divide(left, right):
+    """ Integer division truncating toward zero, as $(( )) does """
+    if right == 0:
+        raise ExpansionError("division by 0")
+    quotient = abs(left) // abs(right)
+    return quotient if (left < 0) == (right < 0) else -quotient
+
+def arithmetic_power(base, exponent):
+    if exponent < 0:
+        raise ExpansionError("exponent less than 0")
+    return pow(base, exponent, 1 << 64)
+
+ARITHMETIC_BINARY = {
+    '**': arithmetic_power,
+    '*': lambda a, b: a * b,
+    '/': c_divide,
+    '%': lambda a, b: a - b * c_divide(a, b),
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '<<': lambda a, b: a << (b & 63),
+    '>>': lambda a, b: a >> (b & 63),
+    '<': lambda a, b: int(a < b),
+    '<=': lambda a, b: int(a <= b),
+    '>': lambda a, b: int(a > b),
+    '>=': lambda a, b: int(a >= b),
+    '==': lambda a, b: int(a == b),
+    '!=': lambda a, b: int(a != b),
+    '&': lambda a, b: a & b,
+    '^': lambda a, b: a ^ b,
+    '|': lambda a, b: a | b,
+}
+ARITHMETIC_UNARY = {
+    '-': lambda a: -a,
+    '+': lambda a: a,
+    '~': lambda a: ~a,
+    '!': lambda a: int(not a),
+}
+ARITHMETIC_PRECEDENCE = {
+    '||': 1, '&&': 2, '|': 3, '^': 4, '&': 5, '==': 6, '!=': 6,
+    '<': 7, '<=': 7, '>': 7, '>=': 7, '<<': 8, '>>': 8,
+    '+': 9, '-': 9, '*': 10, '/': 10, '%': 10, '**': 11,
+}
+
+def wrap_integer(value):
+    """ value as a signed 64-bit integer, wrapping around like C """
+    value &= 0xffffffffffffffff
+    return value - (1 << 64) if value >> 63 else value
+
+def arithmetic_constant(text):
+    """ An integer constant as C writes it: 0x hexadecimal, a leading 0 octal """
+    try:
+        if not text.isalnum():
+            raise ValueError
+        if text[:2] in ('0x', '0X'):
+            return wrap_integer(int(text[2:], 16))
+        if text[:1] == '0':
+            return wrap_integer(int(text, 8))
+        return wrap_integer(int(text, 10))
+    except ValueError:
+        raise ExpansionError(f'{text}: value too great for base (error token is "{text}")')
+
+def evaluate_arithmetic(expression):
+    """ Evaluate a $(( )) body over signed 64-bit integers; names read shell
+    variables """
+    tokens = []
+    position = 0
+    end = len(expression.rstrip())
+    while position < end:
+        match = ARITHMETIC_TOKEN.match(expression, position)
+        if match is None:
+            raise ExpansionError(f"{expression.strip()}: syntax error in expression")
+        tokens.append(match.group(1) or match.group(2))
+        position = match.end()
+    if not tokens:
+        return 0
+    tokens.append(None)
+    index = 0
+
+    def syntax_error():
+        return ExpansionError(f"{expression.strip()}: syntax error in expression")
+
+    def parse_operand():
+        nonlocal index
+        token = tokens[index]
+        index += 1
+        if token in ARITHMETIC_UNARY:
+            return ('unary', token, parse_operand())
+        if token == '(':
+            node = parse_binary(1)
+            if tokens[index] != ')':
+                raise syntax_error()
+            index += 1
+            return node
+        if token is None or not (token[0].isalnum() or token[0] == '_'):
+            raise syntax_error()
+        if token[0].isdigit():
+            return ('constant', arithmetic_constant(token))
+        return ('name', token)
+
+    def parse_binary(minimum):
+        nonlocal index
+        left = parse_operand()
+        while (precedence := ARITHMETIC_PRECEDENCE.get(tokens[index], 0)) >= minimum:
+            op = tokens[index]
+            index += 1
+            # ** groups to the right, everything else to the left
+            right = parse_binary(precedence if op == '**' else precedence + 1)
+            left = ('binary', op, left, right)
+        return left
+
+    def evaluate(node):
+        match node:
+            case ('constant', value):
+                return value
+            case ('name', name):
+                value = (parameter_value(name) or '0').strip()
+                sign = -1 if value[:1] == '-' else 1
+                return wrap_integer(sign * arithmetic_constant(value.lstrip('+-') or '0'))
+            case ('unary', op, operand):
+                return wrap_integer(ARITHMETIC_UNARY[op](evaluate(operand)))
+            case ('binary', '&&', left, right):
+                return int(bool(evaluate(left)) and bool(evaluate(right)))
+            case ('binary', '||', left, right):
+                return int(bool(evaluate(left)) or bool(evaluate(right)))
+            case ('binary', op, left, right):
+                return wrap_integer(ARITHMETIC_BINARY[op](evaluate(left), evaluate(right)))
+
+    tree = parse_binary(1)
+    if tokens[index] is not None:
+        raise syntax_error()
+    return evaluate(tree)
+
+def expand_step(kind, value):
+    match kind:
+        case 'lit':
+            return value
+        case 'tilde':
+            return os.path.expanduser(value)
+        case 'param':
+            return expand_parameter(*value)
+        case 'cmd':
+            return command_substitution(value)
+        case 'arith':
+            return str(evaluate_arithmetic(expand_text(value)))
+
+def expand_text(steps):
+    return ''.join(expand_step(kind, value) for kind, value, _ in steps)
+
+def glob_escape(text):
+    return GLOB_MAGIC.sub(r'[\g<0>]', text)
+
+def expand_glob(pattern, listings):
+    """ Sorted pathnames matching pattern
+
+    listings maps each directory read so far to its entries, so a directory
+    is listed once however many words of the command walk through it.
+    """
+    import fnmatch
+
+    paths = ['/'] if pattern.startswith('/') else ['']
+    components = pattern.lstrip('/').split('/')
+    last_literal = False
+
+    for component in components:
+        if not component:
+            paths = [path + '/' for path in paths if os.path.isdir(path or '.')]
+            continue
+
+        if not GLOB_MAGIC.search(component):
+            paths = [join_glob_path(path, component) for path in paths]
+            last_literal = True
+            continue
+
+        last_literal = False
+        match_name = re.compile(fnmatch.translate(component)).match
+        show_hidden = component[0] == '.'
+        matches = []
+        for path in paths:
+            names = listings.get(path)
+            if names is None:
+                try:
+                    names = sorted(os.listdir(path or '.'))
+                except OSError:
+                    names = []
+                listings[path] = names
+            for name in names:
+                if (show_hidden or name[0] != '.') and match_name(name):
+                    matches.append(join_glob_path(path, name))
+        paths = matches
+
+    if last_literal:
+        paths = [path for path in paths if os.path.lexists(path)]
+    return paths
+
+def join_glob_path(directory, name):
+    if not directory or directory.endswith('/'):
+        return directory + name
+    return directory + '/' + name
+
+def expand_word(word, listings):
+    """ Expand word into its fields: unquoted expansion results are split on
+    whitespace, then fields with unquoted glob characters become the
+    pathnames they match """
+    plan = word_plan(word)
+    if plan is None:
+        return [word.text]
+
+    fields = []
+    field = []
+    # the field again with quoted text escaped, for globbing
+    pattern = []
+    magic = False
+    present = False
+
+    def finish_field():
+        nonlocal field, pattern, magic, present
+
+        if magic:
+            fields.extend(expand_glob(''.join(pattern), listings) or [''.join(field)])
+        elif present:
+            fields.append(''.join(field))
+        field = []
+        pattern = []
+        magic = present = False
+
+    for kind, value, quoted in plan:
+        if quoted and kind == 'param' and value[:3] == (False, '@', None):
+            # "$@" is one field per positional parameter, and none without any
+            for index, argument in enumerate(positional_parameters[1:]):
+                if index:
+                    finish_field()
+                field.append(argument)
+                pattern.append(glob_escape(argument))
+                present = True
+            continue
+
+        text = expand_step(kind, value)
+        if quoted:
+            field.append(text)
+            pattern.append(glob_escape(text))
+            present = True
+        elif kind == 'lit':
+            field.append(text)
+            pattern.append(text)
+            magic = magic or GLOB_MAGIC.search(text) is not None
+            present = present or bool(text)
+        else:
+            pieces = text.split()
+            if text[:1].isspace():
+                finish_field()
+            for index, piece in enumerate(pieces):
+                if index:
+                    finish_field()
+                field.append(piece)
+                pattern.append(piece)
+                magic = magic or GLOB_MAGIC.search(piece) is not None
+                present = True
+            if pieces and text[-1:].isspace():
+                finish_field()
+
+    finish_field()
+    return fields
+
+def expand_value(word):
+    """ Expand word to one string, without splitting or globbing """
+    plan = word_plan(word)
+    if plan is None:
+        return word.text
+    return expand_text(plan)
+
+def expand_command(command):
+    """ The Command as it runs, with words expanded into fields and
+    redirection targets expanded; one with nothing to expand is returned as is """
+    if command.plain is None:
+        command.plain = True
+        for word in itertools.chain(command.words, (redirect.target for redirect in command.redirects)):
+            if word_plan(word) is not None:
+                command.plain = False
+                break
+    if command.plain:
+        return command
+
+    listings = {}
+    words = []
+    for word in command.words:
+        words.extend(Word([(field, "'")]) for field in expand_word(word, listings))
+
+    redirects = []
+    for redirect in command.redirects:
+        targets = expand_word(redirect.target, listings)
+        if len(targets) != 1:
+            raise ExpansionError(f"{redirect.target.text}: ambiguous redirect")
+        redirects.append(Redirection(redirect.fd, redirect.op, Word([(targets[0], "'")])))
+
+    expanded = Command(words, redirects, command.assignments)
+    expanded.plain = True
+    return expanded
+
+def expand_assignments(command):
+    """ (name, value) for each leading NAME=value word of command """
+    assignments = []
+    for word in command.assignments:
+        (text, quote), *rest = word.parts
+        name = ASSIGNMENT_WORD.match(text).group(1)
+        value = Word([(text[len(name) + 1:], quote)] + rest)
+        assignments.append((name, expand_value(value)))
+    return assignments
+
+class RedirectionError(Exception):
+    pass
+
+def here_string_fd(text):
+    """ A readable fd positioned at the start of text, for <<< """
+    data = os.fsencode(text)
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('here-string', os.MFD_CLOEXEC)
+    else:
+        import tempfile
+
+        fd = os.dup(tempfile.TemporaryFile().fileno())
+    os.write(fd, data)
+    os.lseek(fd, 0, os.SEEK_SET)
+    return fd
+
+def open_redirections(redirects, stdin_fd=None, stdout_fd=None):
+    """ Open every redirection target once, left to right
+
+    Returns (fd_map, opened): fd_map maps 0, 1 and 2 to the fd the command
+    should get there (the shell's own fd when it is unchanged); opened lists
+    the fds created here, which the caller closes once the command has them.
+    """
+    fd_map = {
+        0: 0 if stdin_fd is None else stdin_fd,
+        1: 1 if stdout_fd is None else stdout_fd,
+        2: 2,
+    }
+    opened = []
+
+    try:
+        for redirect in redirects:
+            op = redirect.op
+            target = redirect.target.text
+            if redirect.fd not in fd_map:
+                raise RedirectionError(f"{redirect.fd}: redirection of this file descriptor is not supported")
+
+            if op in ('>&', '<&') and target.isdigit():
+                source = fd_map.get(int(target))
+                if source is None:
+                    raise RedirectionError(f"{target}: Bad file descriptor")
+                if source <= 2 and source != redirect.fd:
+                    # the child's 0-2 are replaced in order; duplicate the
+                    # shell's own descriptor so a later dup2 can't clobber it
+                    source = os.dup(source)
+                    opened.append(source)
+                fd_map[redirect.fd] = source
+                continue
+
+            if op == '<<<':
+                fd = here_string_fd(target + "\n")
+            else:
+                if op == '<':
+                    flags = os.O_RDONLY
+                elif op in ('>>', '&>>'):
+                    flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+                else:
+                    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+                try:
+                    fd = os.open(target, flags, 0o666)
+                except OSError as e:
+                    raise RedirectionError(f"{target}: {e.strerror}")
+            opened.append(fd)
+
+            # `&>file`, `&>>file` and `>&file` send both stdout and stderr
+            if op in ('&>', '&>>', '>&'):
+                fd_map[1] = fd_map[2] = fd
+            else:
+                fd_map[redirect.fd] = fd
+    except BaseException:
+        for fd in opened:
+            os.close(fd)
+        raise
+
+    return fd_map, opened
+
+def prefix_matches(names, prefix):
+    """ Slice of the sorted list names that start with prefix """
+    start = bisect_left(names, prefix)
+    end = bisect_left(names, prefix + '\U0010ffff', start)
+    return names[start:end]
+
+def get_command_names(scan=True):
+    """ Sorted builtins and PATH executables, rebuilt only when PATH changes """
+    global command_names
+
+    executables = get_executables_in_path(scan)
+    key = path_executables[0]
+    if command_names[0] != key:
+        command_names = (key, sorted(set(executables).union(BUILTINS)))
+
+    return command_names[1]
+
+def list_directory(directory):
+    """ Sorted entry names of directory (dirs suffixed with /), cached by mtime """
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        directory_listings.pop(directory, None)
+        return []
+
+    cached = directory_listings.get(directory)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    names = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    names.append(entry.name + '/' if entry.is_dir() else entry.name)
+                except OSError:
+                    names.append(entry.name)
+    except OSError:
+        pass
+    names.sort()
+
+    directory_listings[directory] = (mtime, names)
+    return names
+
+def complete_filename(text):
+    directory, prefix = os.path.split(text)
+    names = list_directory(os.path.expanduser(directory) or '.')
+    matches = prefix_matches(names, prefix)
+    if not prefix:
+        matches = [name for name in matches if not name.startswith('.')]
+    if not directory:
+        return matches
+    if not directory.endswith('/'):
+        directory += '/'
+    return [directory + name for name in matches]
+
+def completion_candidates(text):
+    line = readline.get_line_buffer()
+    before = line[:readline.get_begidx()].rstrip()
+    if not before or before[-1] in '|&;':
+        # while the startup scan runs, complete from what it has indexed so far
+        names = get_command_names(scan=not path_index_warming.is_set())
+        return prefix_matches(names, text) if text else []
+    return complete_filename(text)
+
+def completer(text, state):
+    global last_completion_text, last_matches, tab_count
+
+    try:
+        all_options = last_matches
+
+        if state == 0:
+            if text != last_completion_text:
+                all_options = completion_candidates(text)
+                last_completion_text = text
+                last_matches = all_options
+                tab_count = 1
+            else:
+                tab_count += 1
+
+        if len(all_options) == 0:
+            return None
+        elif len(all_options) == 1:
+            if state != 0:
+                return None
+            # directories keep completing into their contents
+            return all_options[0] if all_options[0].endswith('/') else all_options[0] + ' '
+        else:
+            if tab_count == 1:
+                if state == 0:
+                    # ring the bell
+                    sys.stdout.write('\a')
+                    sys.stdout.flush()
+
+                    # partial completion
+                    common_prefix = os.path.commonprefix(all_options)
+                    if (len(common_prefix) > len(text)):
+                        return common_prefix
+                
+                return None
+            
+            elif tab_count >= 2:
+                if state == 0:
+                    names = [
+                        os.path.basename(option.rstrip('/')) + ('/' if option.endswith('/') else '')
+                        for option in all_options
+                    ]
+                    print()
+                    print("  ".join(names))
+                    
+                    # redraw the prompt and current input
+                    sys.stdout.write("$ " + readline.get_line_buffer())
+                    sys.stdout.flush()
+
+                return None
+            
+        return None
+    except Exception as e:
+        print(e)
+
+def execute_single_command(parsed_command):
+    global last_exit_status, substitution_status
+
+    substitution_status = None
+    try:
+        parsed_command = expand_command(parsed_command)
+        command_with_args = parsed_command.argv
+        if not command_with_args:
+            for name, value in expand_assignments(parsed_command):
+                set_variable(name, value)
+    except ExpansionError as e:
+        print(e, file=sys.stderr)
+        last_exit_status = 1
+        return
+    # a bare assignment keeps the status of its last command substitution;
+    # commands set their own, so exit and return still see the previous one
+    if not command_with_args and substitution_status is None:
+        last_exit_status = 0
+
+    if command_with_args and command_with_args[0] in functions:
+        run_redirected(parsed_command.redirects, call_function, command_with_args)
+        return
+    builtin = BUILTINS.get(command_with_args[0]) if command_with_args else None
+    if command_with_args and (builtin is None or builtin.run is None):
+        # external commands run as a one-stage pipeline so they get the
+        # same process-group and job handling as everything else
+        execute_pipeline(Pipeline([parsed_command]))
+        return
+    if not parsed_command.redirects:
+        if builtin:
+            last_exit_status = builtin.run(command_with_args, sys.stdin, sys.stdout, sys.stderr)
+        return
+
+    try:
+        fd_map, opened = open_redirections(parsed_command.redirects)
+    except (RedirectionError, OSError) as e:
+        print(e, file=sys.stderr)
+        last_exit_status = 1
+        return
+
+    streams = ()
+    try:
+        streams = open_builtin_streams(fd_map)
+        if builtin:
+            last_exit_status = builtin.run(command_with_args, *streams)
+            streams[1].flush()
+    except OSError as e:
+        print(f"{command_with_args[0]}: write error: {e.strerror}", file=sys.stderr)
+        last_exit_status = 1
+    finally:
+        close_builtin_streams(streams)
+        for fd in opened:
+            os.close(fd)
+
+def export_builtin(command_with_args, stdin, stdout, stderr):
+    status = 0
+    if len(command_with_args) < 2:
+        for name, value in sorted(os.environ.items()):
+            escaped = value.replace('\\', '\\\\').replace('"', '\\"')
+            stdout.write(f'declare -x {name}="{escaped}"\n')
+        return status
+
+    for arg in command_with_args[1:]:
+        name, has_value, value = arg.partition('=')
+        if not PARAMETER_NAME.fullmatch(name) or not (name[0].isalpha() or name[0] == '_'):
+            stderr.write(f"export: `{arg}': not a valid identifier\n")
+            status = 1
+            continue
+        if not has_value:
+            value = shell_variables.get(name)
+            if value is None:
+                continue
+        shell_variables.pop(name, None)
+        os.environ[name] = value
+        environment_changed()
+    return status
+
+def unset_builtin(command_with_args, stdin, stdout, stderr):
+    for name in command_with_args[1:]:
+        functions.pop(name, None)
+        shell_variables.pop(name, None)
+        if os.environ.pop(name, None) is not None:
+            environment_changed()
+    return 0
+
+def alias_builtin(command_with_args, stdin, stdout, stderr):
+    status = 0
+    for name in command_with_args[1:] or sorted(aliases):
+        name, has_value, value = name.partition('=')
+        if has_value:
+            aliases[name] = value
+            # aliases are applied while parsing, so cached parses are stale
+            parse_cache.clear()
+        elif name in aliases:
+            quoted = aliases[name].replace("'", "'\\''")
+            stdout.write(f"alias {name}='{quoted}'\n")
+        else:
+            stderr.write(f"alias: {name}: not found\n")
+            status = 1
+    return status
+
+def unalias_builtin(command_with_args, stdin, stdout, stderr):
+    status = 0
+    for name in command_with_args[1:]:
+        if name == '-a':
+            aliases.clear()
+        elif aliases.pop(name, None) is None:
+            stderr.write(f"unalias: {name}: not found\n")
+            status = 1
+    parse_cache.clear()
+    return status
+
+def file_mode(path):
+    try:
+        return os.stat(path).st_mode
+    except (OSError, ValueError):
+        return None
+
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except (OSError, ValueError):
+        return None
+
+def test_integer(text):
+    try:
+        return int(text.strip())
+    except ValueError:
+        raise ValueError(f"{text}: integer expression expected")
+
+def same_file(left, right):
+    try:
+        return os.path.samefile(left, right)
+    except (OSError, ValueError):
+        return False
+
+TEST_UNARY = {
+    '-e': lambda path: file_mode(path) is not None,
+    '-f': lambda path: stat.S_ISREG(file_mode(path) or 0),
+    '-d': lambda path: stat.S_ISDIR(file_mode(path) or 0),
+    '-p': lambda path: stat.S_ISFIFO(file_mode(path) or 0),
+    '-S': lambda path: stat.S_ISSOCK(file_mode(path) or 0),
+    '-b': lambda path: stat.S_ISBLK(file_mode(path) or 0),
+    '-c': lambda path: stat.S_ISCHR(file_mode(path) or 0),
+    '-L': os.path.islink,
+    '-h': os.path.islink,
+    '-s': lambda path: os.path.exists(path) and os.path.getsize(path) > 0,
+    '-r': lambda path: os.access(path, os.R_OK),
+    '-w': lambda path: os.access(path, os.W_OK),
+    '-x': lambda path: os.access(path, os.X_OK),
+    '-t': lambda fd: os.isatty(test_integer(fd)),
+    '-z': lambda text: not text,
+    '-n': lambda text: bool(text),
+}
+TEST_BINARY = {
+    '=': lambda left, right: left == right,
+    '==': lambda left, right: left == right,
+    '!=': lambda left, right: left != right,
+    '<': lambda left, right: left < right,
+    '>': lambda left, right: left > right,
+    '-eq': lambda left, right: test_integer(left) == test_integer(right),
+    '-ne': lambda left, right: test_integer(left) != test_integer(right),
+    '-lt': lambda left, right: test_integer(left) < test_integer(right),
+    '-le': lambda left, right: test_integer(left) <= test_integer(right),
+    '-gt': lambda left, right: test_integer(left) > test_integer(right),
+    '-ge': lambda left, right: test_integer(left) >= test_integer(right),
+    '-nt': lambda left, right: (file_mtime(left) or 0) > (file_mtime(right) or 0) and file_mtime(left) is not None,
+    '-ot': lambda left, right: (file_mtime(left) or 0) < (file_mtime(right) or 0) and file_mtime(right) is not None,
+    '-ef': same_file,
+}
+
+def evaluate_test(args):
+    """ Evaluate test arguments, by the POSIX rules for how many there are """
+    match len(args):
+        case 0:
+            return False
+        case 1:
+            return args[0] != ''
+        case 2:
+            if args[0] == '!':
+                return args[1] == ''
+            if args[0] in TEST_UNARY:
+                return TEST_UNARY[args[0]](args[1])
+            raise ValueError(f"{args[0]}: unary operator expected")
+        case 3:
+            if args[1] in TEST_BINARY:
+                return TEST_BINARY[args[1]](args[0], args[2])
+            if args[0] == '!':
+                return not evaluate_test(args[1:])
+            if args[0] == '(' and args[2] == ')':
+                return evaluate_test(args[1:2])
+        case 4:
+            if args[0] == '!':
+                return not evaluate_test(args[1:])
+            if args[0] == '(' and args[3] == ')':
+                return evaluate_test(args[1:3])
+
+    # -o binds looser than -a; split at the last one outside parentheses
+    for operator in ('-o', '-a'):
+        depth = 0
+        for index in range(len(args) - 2, 0, -1):
+            if args[index] == ')':
+                depth += 1
+            elif args[index] == '(':
+                depth -= 1
+            elif depth == 0 and args[index] == operator:
+                left = evaluate_test(args[:index])
+                if operator == '-o':
+                    return left or evaluate_test(args[index + 1:])
+                return left and evaluate_test(args[index + 1:])
+    if args[0] == '!':
+        return not evaluate_test(args[1:])
+    if args[0] == '(' and args[-1] == ')':
+        return evaluate_test(args[1:-1])
+    raise ValueError("too many arguments")
+
+def test_builtin(command_with_args, stdin, stdout, stderr):
+    """ test and [ """
+    command, *args = command_with_args
+    if command == '[':
+        if not args or args[-1] != ']':
+            stderr.write("[: missing `]'\n")
+            return 2
+        args.pop()
+
+    try:
+        return 0 if evaluate_test(args) else 1
+    except ValueError as e:
+        stderr.write(f"{command}: {e}\n")
+        return 2
+
+def exit_builtin(command_with_args, stdin, stdout, stderr):
+    """ exit [n]: n defaults to the last command's status """
+    if len(command_with_args) < 2:
+        sys.exit(last_exit_status)
+    try:
+        sys.exit(int(command_with_args[1]) & 0xff)
+    except ValueError:
+        stderr.write(f"exit: {command_with_args[1]}: numeric argument required\n")
+        sys.exit(2)
+
+def echo_builtin(command_with_args, stdin, stdout, stderr):
+    stdout.write(" ".join(command_with_args[1:]) + "\n")
+    return 0
+
+def type_builtin(command_with_args, stdin, stdout, stderr):
+    if len(command_with_args) < 2:
+        return 0
+
+    description = type_description(command_with_args[1])
+    stdout.write(description + "\n")
+    return 1 if description.endswith(" not found") else 0
+
+def pwd_builtin(command_with_args, stdin, stdout, stderr):
+    stdout.write(os.getcwd() + "\n")
+    return 0
+
+def cd_builtin(command_with_args, stdin, stdout, stderr):
+    try:
+        if len(command_with_args) < 2 or command_with_args[1] == '~':
+            os.chdir(os.path.expanduser('~'))
+        else:
+            os.chdir(command_with_args[1])
+    except Exception:
+        stdout.write(f"cd: {command_with_args[1]}: No such file or directory\n")
+        return 1
+    return 0
+
+def write_history(stdout, start=0):
+    """ List entries from the start'th on, numbered, a block per write """
+    entries = history.lines(start)
+    number = start + 1
+    while block := list(itertools.islice(entries, HistoryList.BLOCK_ENTRIES)):
+        stdout.write(''.join(f"{i} {line}\n" for i, line in enumerate(block, number)))
+        number += len(block)
+
+def search_history(pattern):
+    """ (entry number, line) for history entries containing pattern, numbered
+    as `history` and !N number them
+
+    The $HISTFILE index answers when the file ends with exactly the entries
+    in the list, so its line numbers are the entry numbers shifted; lines
+    before that were trimmed from the list and aren't entries any more. Once
+    history -r, -c or another shell has put the two out of step, the list
+    itself is searched.
+    """
+    if history_index and len(history):
+        history_index.update()
+        shift = len(history_index) - len(history)
+        if shift >= 0 and history_index.line(shift + 1) == history[0] \
+                and history_index.line(len(history_index)) == history[-1]:
+            matches = []
+            for line_number, line in history_index.search(pattern):
+                number = line_number - shift
+                if number < 1:
+                    continue
+                if history[number - 1] != line:
+                    break
+                matches.append((number, line))
+            else:
+                return matches
+    return history.search(pattern)
+
+def history_builtin(command_with_args, stdin, stdout, stderr):
+    """ List, search, read and write history; listings stream line by line,
+    so `history | head` stops as soon as the reader does """
+    ensure_history_loaded()
+    if history_file:
+        history_file.flush()
+
+    if len(command_with_args) < 2:
+        write_history(stdout)
+        return 0
+
+    option = command_with_args[1]
+    file_path = command_with_args[2] if len(command_with_args) > 2 else None
+    if option in ('-r', '-w', '-a') and not file_path:
+        stdout.write(f"history: {option}: file argument required\n")
+        return 1
+
+    if option == '-r':
+        if os.path.exists(file_path):
+            try:
+                # Append file history to current history
+                add_to_history(read_history_lines(file_path))
+            except Exception as e:
+                stdout.write(f"history: {file_path}: {e}\n")
+                return 1
+    elif option == '-w':
+        try:
+            with open(file_path, 'wb') as f:
+                history.write(f)
+        except Exception as e:
+            stdout.write(f"history: {file_path}: {e}\n")
+            return 1
+    elif option == '-a':
+        try:
+            # positions count every entry ever added, so trimming doesn't shift them
+            last_position = history_file_positions.get(file_path, 0)
+            with open(file_path, 'ab') as f:
+                history.write(f, last_position - history.removed)
+            history_file_positions[file_path] = history.removed + len(history)
+        except Exception as e:
+            stdout.write(f"history: {file_path}: {e}\n")
+            return 1
+    elif option == '-s':
+        if not file_path:
+            stdout.write("history: -s: search string required\n")
+            return 1
+
+        pattern = file_path
+        for number, line in search_history(pattern):
+            stdout.write(f"{number} {line}\n")
+    else:
+        try:
+            num = min(int(option), len(history))
+        except ValueError:
+            stdout.write(f"history: {option}: numeric argument required\n")
+            return 1
+
+        write_history(stdout, len(history) - num)
+    return 0
+
+def hash_builtin(command_with_args, stdin, stdout, stderr):
+    if len(command_with_args) < 2:
+        if not hashed_commands:
+            stdout.write("hash: hash table empty\n")
+            return 0
+
+        stdout.write("hits\tcommand\n")
+        for path, hits in hashed_commands.values():
+            stdout.write(f"{hits:4}\t{path}\n")
+    elif command_with_args[1] == '-r':
+        hashed_commands.clear()
+        path_dir_cache.clear()
+    elif command_with_args[1] == '-p':
+        if len(command_with_args) < 4:
+            stderr.write("hash: -p: usage: hash -p pathname name\n")
+            return 1
+
+        get_path_dirs()
+        hashed_commands[command_with_args[3]] = [command_with_args[2], 0]
+    else:
+        status = 0
+        for name in command_with_args[1:]:
+            if name in BUILTINS or '/' in name:
+                continue
+            if find_executable(name):
+                hashed_commands[name][1] = 0
+            else:
+                stderr.write(f"hash: {name}: not found\n")
+                status = 1
+        return status
+    return 0
+
+def parsecache_builtin(command_with_args, stdin, stdout, stderr):
+    if len(command_with_args) > 1 and command_with_args[1] == '-c':
+        parse_cache.clear()
+        parse_cache_stats['hits'] = parse_cache_stats['misses'] = 0
+        return 0
+
+    hits = parse_cache_stats['hits']
+    misses = parse_cache_stats['misses']
+    ratio = hits / (hits + misses) * 100 if hits + misses else 0.0
+    stdout.write(f"entries: {len(parse_cache)}/{PARSE_CACHE_SIZE}\n")
+    stdout.write(f"hits: {hits}\n")
+    stdout.write(f"misses: {misses}\n")
+    stdout.write(f"hit ratio: {ratio:.1f}%\n")
+    return 0
+
+def jobs_builtin(command_with_args, stdin, stdout, stderr):
+    reap_jobs()
+    for job in list(jobs.values()):
+        stdout.write(format_job(job) + "\n")
+        if job.state == 'Done':
+            del jobs[job.number]
+    return 0
+
+def fg_bg_builtin(command_with_args, stdin, stdout, stderr):
+    command = command_with_args[0]
+    job = find_job(command_with_args[1] if len(command_with_args) > 1 else '%+')
+    if job is None:
+        spec = command_with_args[1] if len(command_with_args) > 1 else 'current'
+        stderr.write(f"{command}: {spec}: no such job\n")
+        return 1
+
+    if command == 'bg':
+        continue_job(job)
+        stdout.write(f"[{job.number}]{job_marker(job)} {job.command_line} &\n")
+        return 0
+
+    stdout.write(job.command_line + "\n")
+    stdout.flush()
+    continue_job(job)
+    return wait_for_job(job, foreground=True)
+
+def wait_builtin(command_with_args, stdin, stdout, stderr):
+    targets = []
+    for spec in command_with_args[1:]:
+        job = find_job(spec)
+        if job is None:
+            stderr.write(f"wait: {spec}: no such job\n")
+            return 127
+        targets.append(job)
+
+    status = 0
+    for job in targets or list(jobs.values()):
+        if job.state != 'Stopped':
+            status = wait_for_job(job)
+    return status
+
+def true_builtin(command_with_args, stdin, stdout, stderr):
+    return 0
+
+def false_builtin(command_with_args, stdin, stdout, stderr):
+    return 1
+
+def loop_control_builtin(command_with_args, stdin, stdout, stderr):
+    """ break and continue """
+    command = command_with_args[0]
+    levels = 1
+    if len(command_with_args) > 1:
+        try:
+            levels = int(command_with_args[1])
+        except ValueError:
+            stderr.write(f"{command}: {command_with_args[1]}: numeric argument required\n")
+            return 1
+        if levels < 1:
+            stderr.write(f"{command}: {levels}: loop count out of range\n")
+            return 1
+    if not loop_depth:
+        stderr.write(f"{command}: only meaningful in a `for', `while', or `until' loop\n")
+        return 0
+    raise LoopControl(command, min(levels, loop_depth))
+
+def return_builtin(command_with_args, stdin, stdout, stderr):
+    status = last_exit_status
+    if len(command_with_args) > 1:
+        try:
+            status = int(command_with_args[1]) & 0xff
+        except ValueError:
+            stderr.write(f"return: {command_with_args[1]}: numeric argument required\n")
+            status = 2
+    if not function_depth:
+        stderr.write("return: can only `return' from a function\n")
+        return 1
+    raise FunctionReturn(status)
+
+def type_description(query):
+    """ What `type query` reports """
+    if query in aliases:
+        return f"{query} is aliased to `{aliases[query]}'"
+    if query in RESERVED_WORDS:
+        return f"{query} is a shell keyword"
+    if query in functions:
+        return f"{query} is a function\n{format_command(FunctionDefinition(query, functions[query]))}"
+    if query in BUILTINS:
+        return f"{query} is a shell builtin"
+
+    executable_path = find_executable(query)
+    if executable_path:
+        return f"{query} is {executable_path}"
+    return f"{query} not found"
+
+def open_builtin_streams(fd_map):
+    """ Text streams on fd_map's 0-2 for a builtin, reusing the shell's own
+    streams where a descriptor is unchanged
+
+    Like the shell's own streams they use surrogateescape, so arguments
+    holding arbitrary bytes are written back out byte for byte.
+    """
+    if fd_map[1] != 1 or fd_map[2] != 2:
+        # keep already buffered output ahead of anything the builtin writes
+        sys.stdout.flush()
+    return (
+        sys.stdin if fd_map[0] == 0 else open(fd_map[0], 'r', errors='surrogateescape', closefd=False),
+        sys.stdout if fd_map[1] == 1 else open(fd_map[1], 'w', errors='surrogateescape', closefd=False),
+        sys.stderr if fd_map[2] == 2 else open(fd_map[2], 'w', errors='surrogateescape', closefd=False),
+    )
+
+def close_builtin_streams(streams):
+    for stream, own in zip(streams, (sys.stdin, sys.stdout, sys.stderr)):
+        if stream is not own:
+            try:
+                stream.close()
+            except OSError:
+                # already reported by whoever flushed it first
+                pass
+
+def run_builtin(command_with_args):
+    """ Run a builtin on the shell's own streams """
+    global last_exit_status
+
+    last_exit_status = BUILTINS[command_with_args[0]].run(command_with_args, sys.stdin, sys.stdout, sys.stderr)
+
+def run_builtin_stage(builtin, command_with_args, fd_map, owned_fds, outcome):
+    """ Thread body for a threaded builtin inside a pipeline; its status goes in outcome[0] """
+    streams = ()
+    try:
+        streams = open_builtin_streams(fd_map)
+        outcome[0] = builtin.run(command_with_args, *streams)
+        streams[1].flush()
+    except BrokenPipeError:
+        outcome[0] = 128 + signal.SIGPIPE
+    except OSError as e:
+        os.write(fd_map[2], f"{command_with_args[0]}: write error: {e.strerror}\n".encode())
+        outcome[0] = 1
+    finally:
+        close_builtin_streams(streams)
+        # builtins don't consume piped input; closing it lets the writer see EPIPE
+        for fd in owned_fds:
+            os.close(fd)
+
+class Job:
+    def __init__(self, number, pgid, command_line, returncodes, processes, threads):
+        self.number = number
+        self.pgid = pgid
+        self.command_line = command_line
+        # pid -> exit status, None while the process is still running
+        self.returncodes = returncodes
+        self.processes = processes
+        self.threads = threads
+        self.state = 'Running'
+        self.foreground = False
+        self.term_signal = 0
+
+def word_source(word):
+    """ Shell text that reads back as word """
+    import shlex
+
+    pieces = []
+    in_double_quotes = False
+    for text, quote in word.parts:
+        double_quoted = quote is not None and quote[0] == '"'
+        if double_quoted != in_double_quotes:
+            pieces.append('"')
+            in_double_quotes = double_quoted
+        if quote == '"':
+            pieces.append(re.sub(r'([\\"$`])', r'\\\1', text))
+        elif quote is None or double_quoted or quote[0] == '$':
+            pieces.append(text)
+        else:
+            pieces.append(shlex.quote(text))
+    if in_double_quotes:
+        pieces.append('"')
+    return ''.join(pieces)
+
+def format_list(pipelines):
+    """ A parsed list as one line of shell text, ending in ; or & """
+    text = ''
+    for index, pipeline in enumerate(pipelines):
+        following = pipelines[index + 1] if index + 1 < len(pipelines) else None
+        text += ('! ' if pipeline.negate else '') + format_pipeline(pipeline)
+        if pipeline.background:
+            text += ' &'
+        elif following is None or not following.connector:
+            text += ';'
+        if following is not None:
+            text += f" {following.connector} " if following.connector else ' '
+    return text
+
+def format_command(parsed_command):
+    match parsed_command:
+        case If():
+            clauses = []
+            for index, (condition, body) in enumerate(parsed_command.clauses):
+                clauses.append(f"{'elif' if index else 'if'} {format_list(condition)} then {format_list(body)}")
+            if parsed_command.else_body is not None:
+                clauses.append(f"else {format_list(parsed_command.else_body)}")
+            text = ' '.join(clauses) + ' fi'
+        case Loop():
+            text = f"{parsed_command.keyword} {format_list(parsed_command.condition)} do {format_list(parsed_command.body)} done"
+        case For():
+            text = f"for {parsed_command.name}"
+            if parsed_command.words is not None:
+                text += ' in' + ''.join(' ' + word_source(word) for word in parsed_command.words)
+            text += f"; do {format_list(parsed_command.body)} done"
+        case Group():
+            text = f"{{ {format_list(parsed_command.body)} }}"
+        case FunctionDefinition():
+            return f"{parsed_command.name} () {format_command(parsed_command.body)}"
+        case _:
+            text = ' '.join(word_source(word) for word in parsed_command.assignments + parsed_command.words)
+
+    for redirect in parsed_command.redirects:
+        default_fd = 0 if redirect.op[0] == '<' else 1
+        fd = '' if redirect.fd == default_fd or redirect.op[0] == '&' else str(redirect.fd)
+        text += f" {fd}{redirect.op}{word_source(redirect.target)}"
+    return text
+
+def format_pipeline(pipeline):
+    return " | ".join(format_command(command) for command in pipeline.commands)
+
+def job_marker(job):
+    numbers = sorted(jobs)
+    if numbers and job.number == numbers[-1]:
+        return '+'
+    if len(numbers) > 1 and job.number == numbers[-2]:
+        return '-'
+    return ' '
+
+def format_job(job):
+    state = job.state
+    if state == 'Done' and job.term_signal:
+        state = signal.strsignal(job.term_signal)
+    elif state == 'Done' and job.returncodes[job.processes[-1].pid]:
+        state = f"Exit {job.returncodes[job.processes[-1].pid]}"
+    suffix = ' &' if job.state == 'Running' else ''
+    return f"[{job.number}]{job_marker(job)}  {state:<24}{job.command_line}{suffix}"
+
+def find_job(spec):
+    """ Resolve %n, %+, %%, %- or %prefix (or a bare job number) to a Job """
+    reap_jobs()
+    if not jobs:
+        return None
+
+    numbers = sorted(jobs)
+    key = spec[1:] if spec.startswith('%') else spec
+    if key in ('', '+', '%'):
+        return jobs[numbers[-1]]
+    if key == '-':
+        return jobs[numbers[-2]] if len(numbers) > 1 else jobs[numbers[-1]]
+    if key.isdigit():
+        return jobs.get(int(key))
+    for number in reversed(numbers):
+        if jobs[number].command_line.startswith(key):
+            return jobs[number]
+    return None
+
+def record_job_status(job, pid, status):
+    if os.WIFSTOPPED(status):
+        job.state = 'Stopped'
+    elif os.WIFCONTINUED(status):
+        job.state = 'Running'
+    else:
+        code = os.waitstatus_to_exitcode(status)
+        if code < 0:
+            job.term_signal = -code
+        job.returncodes[pid] = code if code >= 0 else 128 - code
+        for process in job.processes:
+            if process.pid == pid:
+                process.returncode = job.returncodes[pid]
+        if all(code is not None for code in job.returncodes.values()):
+            job.state = 'Done'
+
+def reap_jobs(signum=None, frame=None):
+    """ SIGCHLD handler: collect status changes of background job processes """
+    for job in list(jobs.values()):
+        if job.foreground:
+            continue
+        for pid, code in job.returncodes.items():
+            if code is not None:
+                continue
+            try:
+                wpid, status = os.waitpid(pid, os.WNOHANG | os.WUNTRACED | os.WCONTINUED)
+            except ChildProcessError:
+                job.returncodes[pid] = 0
+                continue
+            if wpid:
+                record_job_status(job, pid, status)
+        if all(code is not None for code in job.returncodes.values()):
+            job.state = 'Done'
+
+def notify_jobs():
+    """ Report and forget background jobs that finished since the last prompt """
+    reap_jobs()
+    for job in list(jobs.values()):
+        if job.state == 'Done':
+            print(format_job(job))
+            del jobs[job.number]
+
+def give_terminal_to(pgid):
+    if not job_control:
+        return
+    # shells move the terminal between groups with SIGTTOU blocked
+    old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTTOU})
+    try:
+        os.tcsetpgrp(sys.stdin.fileno(), pgid)
+    except OSError:
+        pass
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+
+def continue_job(job):
+    if job.state == 'Stopped':
+        job.state = 'Running'
+        try:
+            os.killpg(job.pgid, signal.SIGCONT)
+        except ProcessLookupError:
+            pass
+
+def wait_for_job(job, foreground=False):
+    """ Block until job finishes or stops; return the status of its last stage """
+    job.foreground = True
+    if foreground:
+        give_terminal_to(job.pgid)
+    try:
+        for pid, code in job.returncodes.items():
+            while job.returncodes[pid] is None and job.state != 'Stopped':
+                try:
+                    _, status = os.waitpid(pid, os.WUNTRACED)
+                except ChildProcessError:
+                    job.returncodes[pid] = 0
+                    break
+                record_job_status(job, pid, status)
+            if job.state == 'Stopped':
+                break
+        else:
+            # a stopped job's threads wait on it, so only a finished one's are joined
+            for thread in job.threads:
+                thread.join()
+    finally:
+        if foreground:
+            give_terminal_to(os.getpgrp())
+            if job.term_signal == signal.SIGINT:
+                print()
+        job.foreground = False
+
+    if job.state == 'Stopped':
+        if job.number not in jobs:
+            add_job(job)
+        print()
+        print(format_job(job))
+        return 128 + signal.SIGTSTP
+
+    jobs.pop(job.number, None)
+    return job.returncodes[job.processes[-1].pid]
+
+def add_job(job):
+    job.number = max(jobs, default=0) + 1
+    jobs[job.number] = job
+
+def kill_builtin(command_with_args, stdin, stdout, stderr):
+    args = command_with_args[1:]
+    sig = signal.SIGTERM
+    if args and args[0] == '-s' and len(args) > 1:
+        name, args = args[1], args[2:]
+    elif args and args[0].startswith('-') and len(args[0]) > 1:
+        name, args = args[0][1:], args[1:]
+    else:
+        name = None
+
+    if name is not None:
+        try:
+            sig = signal.Signals(int(name)) if name.isdigit() else signal.Signals['SIG' + name.upper().removeprefix('SIG')]
+        except (KeyError, ValueError):
+            stderr.write(f"kill: {name}: invalid signal specification\n")
+            return 1
+
+    if not args:
+        stderr.write("kill: usage: kill [-s sigspec | -sigspec] pid | jobspec ...\n")
+        return 2
+
+    status = 0
+    for target in args:
+        try:
+            if target.startswith('%'):
+                job = find_job(target)
+                if job is None:
+                    stderr.write(f"kill: {target}: no such job\n")
+                    status = 1
+                    continue
+                os.killpg(job.pgid, sig)
+                if sig in (signal.SIGTERM, signal.SIGKILL, signal.SIGHUP, signal.SIGINT):
+                    continue_job(job)
+            else:
+                os.kill(int(target), sig)
+        except ValueError:
+            stderr.write(f"kill: {target}: arguments must be process or job IDs\n")
+            status = 1
+        except ProcessLookupError:
+            stderr.write(f"kill: ({target}) - No such process\n")
+            status = 1
+    return status
+
+def parse_duration(text):
+    """ Parse a timeout duration such as 10, 1.5, 30s, 5m, 2h or 1d """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    scale = units.get(text[-1:], None)
+    number = text[:-1] if scale else text
+    try:
+        value = float(number) * (scale or 1)
+    except ValueError:
+        raise ValueError(text) from None
+    if value < 0:
+        raise ValueError(text)
+    return value
+
+def parse_limit_value(option, text):
+    if text == 'unlimited':
+        return None
+    try:
+        value = parse_duration(text) if option == 'T' else int(text)
+    except ValueError:
+        raise ValueError(text) from None
+    if value < 0:
+        raise ValueError(text)
+
+    rlimit, scale = RESOURCE_LIMITS[option][2], RESOURCE_LIMITS[option][3]
+    if rlimit is not None:
+        hard = resource.getrlimit(rlimit)[1]
+        if hard != resource.RLIM_INFINITY and value * scale > hard:
+            raise ValueError(f"{text}: exceeds hard limit")
+    return value
+
+def effective_limits(command_limits=None):
+    """ Merge environment defaults, session ulimits and per-command limits """
+    limits = {}
+    for option, (_, _, _, _, env_var) in RESOURCE_LIMITS.items():
+        if env_var in os.environ:
+            try:
+                limits[option] = parse_limit_value(option, os.environ[env_var])
+            except ValueError:
+                pass
+    limits.update(session_limits)
+    if command_limits:
+        limits.update(command_limits)
+    return {option: value for option, value in limits.items() if value}
+
+def limits_preexec(limits):
+    """ Build a preexec_fn that installs limits in the child before exec """
+    def preexec():
+        for option, value in limits.items():
+            _, _, rlimit, scale, _ = RESOURCE_LIMITS[option]
+            if rlimit is None:
+                signal.setitimer(signal.ITIMER_REAL, value)
+            else:
+                resource.setrlimit(rlimit, (int(value * scale), int(value * scale)))
+    return preexec
+
+def ulimit_builtin(command_with_args, stdin, stdout, stderr):
+    args = command_with_args[1:]
+    show_all = not args or args == ['-a']
+    i = 0
+    while not show_all and i < len(args):
+        option = args[i][1:] if args[i].startswith('-') else ''
+        if option not in RESOURCE_LIMITS:
+            stderr.write(f"ulimit: {args[i]}: invalid option\n")
+            stderr.write("ulimit: usage: ulimit [-a] [-tvnT [limit]]\n")
+            return 2
+
+        if i + 1 < len(args) and not args[i + 1].startswith('-'):
+            try:
+                session_limits[option] = parse_limit_value(option, args[i + 1])
+            except ValueError as e:
+                stderr.write(f"ulimit: {e}: invalid limit\n")
+                return 1
+            i += 2
+        else:
+            stdout.write(format_limit(option, verbose=len(args) > 1) + "\n")
+            i += 1
+
+    if show_all:
+        for option in RESOURCE_LIMITS:
+            stdout.write(format_limit(option, verbose=True) + "\n")
+    return 0
+
+def format_limit(option, verbose):
+    description, unit, rlimit, scale, _ = RESOURCE_LIMITS[option]
+    value = effective_limits().get(option)
+    if value is None and rlimit is not None:
+        soft = resource.getrlimit(rlimit)[0]
+        value = None if soft == resource.RLIM_INFINITY else soft // scale
+    text = 'unlimited' if value is None else f"{value:g}"
+    if not verbose:
+        return text
+    label = f"({unit}, -{option})" if unit else f"(-{option})"
+    return f"{description:<20} {label:>16} {text}"
+
+def split_limit_prefix(parsed_command):
+    """ Split `timeout [-t N] [-v N] [-n N] DURATION command ...` into the
+    wrapped Command and its limits """
+    words = parsed_command.words
+    limits = {}
+    i = 1
+    while i < len(words) and words[i].text[:1] == '-' and words[i].text[1:] in RESOURCE_LIMITS:
+        if i + 1 >= len(words):
+            raise ValueError(f"{words[i].text}: option requires an argument")
+        try:
+            limits[words[i].text[1:]] = parse_limit_value(words[i].text[1:], words[i + 1].text)
+        except ValueError as e:
+            raise ValueError(f"{e}: invalid limit") from None
+        i += 2
+
+    if i + 1 >= len(words):
+        raise ValueError("usage: timeout [-t cpu] [-v kbytes] [-n files] duration command [arg ...]")
+    try:
+        limits['T'] = parse_duration(words[i].text)
+    except ValueError:
+        raise ValueError(f"invalid time interval '{words[i].text}'") from None
+    return Command(words[i + 1:], parsed_command.redirects), limits
+
+def start_parallel_job(argv, fd_map):
+    """ Start one parallel job the way a pipeline stage would be started;
+    None if the command can't be found or started """
+    command = argv[0]
+    builtin = BUILTINS.get(command)
+    try:
+        if command in functions or (builtin is not None and builtin.run is not None):
+            action = call_function if command in functions else run_builtin
+            return fork_shell(fd_map, None, action, argv)
+
+        executable_path = find_executable(command)
+        if not executable_path:
+            os.write(fd_map[2], f"{command}: command not found\n".encode())
+            return None
+        return spawn_process(
+            argv,
+            executable_path,
+            stdin=fd_map[0],
+            stdout=fd_map[1] if fd_map[1] != 1 else None,
+            stderr=fd_map[2] if fd_map[2] != 2 else None,
+            limits=effective_limits()
+        )
+    except OSError as e:
+        # a bad interpreter or no room for another process fails this job only
+        os.write(fd_map[2], f"parallel: {command}: {e.strerror}\n".encode())
+        return None
+
+def parallel_builtin(command_with_args, stdin, stdout, stderr):
+    """ parallel [-j jobs] command [arg ...]
+
+    Run the command once per line of input, with the line in place of {} or
+    appended, keeping up to jobs of them running. Finished jobs are noticed
+    through pidfds with poll, so whichever ends first frees its slot. The
+    status is the number of failed jobs, at most 101, as GNU parallel does.
+    """
+    import select
+
+    args = command_with_args[1:]
+    limit = os.cpu_count() or 1
+    if args and args[0].startswith('-j'):
+        value = args[0][2:] or (args[1] if len(args) > 1 else '')
+        args = args[1:] if args[0][2:] else args[2:]
+        try:
+            limit = int(value)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            stderr.write(f"parallel: {value}: invalid number of jobs\n")
+            return 2
+    if not args:
+        stderr.write("parallel: usage: parallel [-j jobs] command [arg ...]\n")
+        return 2
+
+    placeholder = any('{}' in arg for arg in args)
+    stdout.flush()
+    stderr.flush()
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    # jobs read /dev/null: the input lines are parallel's, not theirs
+    fd_map = {0: devnull, 1: stdout.fileno(), 2: stderr.fileno()}
+    use_pidfd = hasattr(os, 'pidfd_open')
+    poller = select.poll() if use_pidfd else None
+    # pid -> pidfd (None without pidfd support), in start order
+    running = {}
+    pids = {}
+    failed = 0
+
+    def reap_one():
+        """ Wait for the first job to finish; without pidfds, the oldest """
+        nonlocal failed
+        if use_pidfd:
+            ready = poller.poll()
+            pid = pids[ready[0][0]]
+        else:
+            pid = next(iter(running))
+        _, status = os.waitpid(pid, 0)
+        pidfd = running.pop(pid)
+        if pidfd is not None:
+            poller.unregister(pidfd)
+            del pids[pidfd]
+            os.close(pidfd)
+        if os.waitstatus_to_exitcode(status):
+            failed += 1
+
+    try:
+        for line in stdin:
+            line = line.rstrip('\n')
+            argv = [arg.replace('{}', line) for arg in args] if placeholder else args + [line]
+            while len(running) >= limit:
+                reap_one()
+            process = start_parallel_job(argv, fd_map)
+            if process is None:
+                failed += 1
+                continue
+            pidfd = None
+            if use_pidfd:
+                pidfd = os.pidfd_open(process.pid)
+                poller.register(pidfd, select.POLLIN)
+                pids[pidfd] = process.pid
+            running[process.pid] = pidfd
+        while running:
+            reap_one()
+    finally:
+        # interrupted: take the remaining jobs down with us
+        for pid, pidfd in running.items():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            os.waitpid(pid, 0)
+            if pidfd is not None:
+                os.close(pidfd)
+        os.close(devnull)
+
+    return min(failed, 101)
+
+class ShellStats:
+    """ Wall time per phase and per input line, optionally traced as JSON lines
+
+    Phase times are inclusive: a parse inside a command substitution also
+    counts towards the expansion that ran it.
+    """
+    __slots__ = ('phases', 'lines', 'line_ns', 'line_phases', 'line_start', 'trace')
+
+    def __init__(self, trace=None):
+        self.phases = {}
+        self.lines = 0
+        self.line_ns = 0
+        self.line_phases = {}
+        self.line_start = None
+        self.trace = trace
+
+    def record(self, phase, elapsed):
+        totals = self.phases.get(phase)
+        if totals is None:
+            totals = self.phases[phase] = [0, 0]
+        totals[0] += 1
+        totals[1] += elapsed
+        if self.line_start is not None:
+            self.line_phases[phase] = self.line_phases.get(phase, 0) + elapsed
+
+    def begin_line(self):
+        self.line_phases = {}
+        self.line_start = time.perf_counter_ns()
+
+    def end_line(self, input_line):
+        if self.line_start is None:
+            return
+        elapsed = time.perf_counter_ns() - self.line_start
+        self.line_start = None
+        self.lines += 1
+        self.line_ns += elapsed
+        if self.trace:
+            import json
+            self.trace.write(json.dumps({
+                'time': time.time(),
+                'line': input_line,
+                'status': last_exit_status,
+                'us': elapsed // 1000,
+                'phases': {phase: ns // 1000 for phase, ns in self.line_phases.items()},
+            }) + '\n')
+
+# phase name -> module function whose calls it times
+INSTRUMENTED_PHASES = {
+    'tokenize': 'tokenize',
+    'parse': 'parse_line',
+    'expand': 'expand_command',
+    'substitute': 'command_substitution',
+    'redirect': 'open_redirections',
+    'lookup': 'find_executable',
+    'spawn': 'spawn_process',
+    'fork': 'fork_shell',
+    'wait': 'wait_for_job',
+}
+
+def instrument(phase, function):
+    def timed(*args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if stats:
+                stats.record(phase, time.perf_counter_ns() - start)
+    timed.__wrapped__ = function
+    return timed
 
+def enable_stats(trace_path=None):
+    """ Start timing phases by swapping the module functions for timed
+    wrappers, so a shell that never opts in runs the plain functions """
+    global stats
 
-def get_executables_in_path():
-    executables = set()
-    path_env = os.environ.get('PATH', '')
+    trace = open(trace_path, 'a', buffering=1) if trace_path else None
+    if stats:
+        if trace:
+            if stats.trace:
+                stats.trace.close()
+            stats.trace = trace
+        return
 
-    for directory in path_env.split(':'):
-        if not directory or not os.path.isdir(directory):
-            continue
+    stats = ShellStats(trace)
+    namespace = globals()
+    for phase, name in INSTRUMENTED_PHASES.items():
+        namespace[name] = instrument(phase, namespace[name])
+    for builtin in BUILTINS.values():
+        if builtin.run:
+            builtin.run = instrument('builtin', builtin.run)
+
+def disable_stats():
+    global stats
+
+    if not stats:
+        return
+    namespace = globals()
+    for name in INSTRUMENTED_PHASES.values():
+        namespace[name] = namespace[name].__wrapped__
+    for builtin in BUILTINS.values():
+        if builtin.run:
+            builtin.run = getattr(builtin.run, '__wrapped__', builtin.run)
+    if stats.trace:
+        stats.trace.close()
+    stats = None
 
+def format_ratio(hits, misses):
+    return f"{hits / (hits + misses) * 100:.1f}%" if hits + misses else "-"
+
+def shellstats_builtin(command_with_args, stdin, stdout, stderr):
+    """ shellstats [on [tracefile] | off | -r] """
+    option = command_with_args[1] if len(command_with_args) > 1 else None
+    if option == 'on':
         try:
-            for filename in os.listdir(directory):
-                filepath = os.path.join(directory, filename)
-                if os.path.isfile(filepath) and os.access(filepath, os.X_OK):
-                    executables.add(filename)
-        except (OSError, PermissionError):
-            continue
+            enable_stats(command_with_args[2] if len(command_with_args) > 2 else None)
+        except OSError as e:
+            stderr.write(f"shellstats: {command_with_args[2]}: {e.strerror}\n")
+            return 1
+        return 0
+    if option == 'off':
+        disable_stats()
+        return 0
+    if option == '-r':
+        if stats:
+            stats.phases.clear()
+            stats.lines = stats.line_ns = 0
+        parse_cache_stats['hits'] = parse_cache_stats['misses'] = 0
+        for counter in path_stats:
+            path_stats[counter] = 0
+        return 0
+    if option is not None:
+        stderr.write(f"shellstats: {option}: invalid option\n")
+        stderr.write("shellstats: usage: shellstats [on [tracefile] | off | -r]\n")
+        return 2
 
-    return list(executables)
+    if stats:
+        stdout.write(f"{'phase':<12}{'calls':>10}{'total ms':>12}{'mean us':>10}\n")
+        for phase in (*INSTRUMENTED_PHASES, 'builtin'):
+            calls, elapsed = stats.phases.get(phase, (0, 0))
+            mean = elapsed / calls / 1000 if calls else 0.0
+            stdout.write(f"{phase:<12}{calls:>10}{elapsed / 1e6:>12.3f}{mean:>10.1f}\n")
+        mean = stats.line_ns / stats.lines / 1000 if stats.lines else 0.0
+        stdout.write(f"{'line':<12}{stats.lines:>10}{stats.line_ns / 1e6:>12.3f}{mean:>10.1f}\n")
+        if stats.trace:
+            stdout.write(f"trace: {stats.trace.name}\n")
+    else:
+        stdout.write("phase timing off (shellstats on)\n")
 
-def find_executable(command):
-    path_env = os.environ.get('PATH', '')
-    for d in path_env.split(':'):
-        if not d:
-            continue
-        candidate = os.path.join(d, command)
-        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
-            return candidate
+    hits, misses = parse_cache_stats['hits'], parse_cache_stats['misses']
+    stdout.write(f"parse cache: {hits} hits, {misses} misses, {format_ratio(hits, misses)}\n")
+    hits, misses = path_stats['hash hits'], path_stats['hash misses']
+    stdout.write(f"hash table: {hits} hits, {misses} misses, {format_ratio(hits, misses)}\n")
+    stdout.write(f"PATH: {path_stats['directory scans']} directory scans, {path_stats['index builds']} index builds\n")
+    return 0
 
-    return None
+def times_builtin(command_with_args, stdin, stdout, stderr):
+    """ User and system time of the shell, then of its waited-for children """
+    times = os.times()
+    for user, system in ((times.user, times.system), (times.children_user, times.children_system)):
+        stdout.write(f"{int(user // 60)}m{user % 60:.3f}s {int(system // 60)}m{system % 60:.3f}s\n")
+    return 0
 
-def parse_pipeline(input_line):
-    """ Parse command line into pipeline segments seperated by | """
-    pipeline_segments = []
-    current_segment = ""
-    in_single_quote = False
-    in_double_quote = False
-    i = 0
+class Builtin:
+    """ A command implemented inside the shell
 
-    while i < len(input_line):
-        char = input_line[i]
+    run(command_with_args, stdin, stdout, stderr) writes to the text streams
+    it is given and returns the exit status, so the same code serves a plain
+    call, redirections and pipeline stages. Threaded builtins only read
+    shell state, so pipelines run them on a thread instead of forking; run
+    is None for timeout, which execute_pipeline unwraps before dispatch.
+    """
+    __slots__ = ('run', 'threaded')
 
-        if char == "'" and not in_double_quote:
-            in_single_quote = not in_single_quote
-            current_segment += char
-        elif char == '"' and not in_single_quote:
-            in_double_quote = not in_double_quote
-            current_segment += char
-        elif char == '|' and not in_double_quote and not in_single_quote:
-            if current_segment.strip():
-                pipeline_segments.append(current_segment.strip())
-
-            current_segment = ""
-        else:
-            current_segment += char
+    def __init__(self, run, threaded=False):
+        self.run = run
+        self.threaded = threaded
 
-        i += 1
+BUILTINS = {
+    'exit': Builtin(exit_builtin),
+    'echo': Builtin(echo_builtin, threaded=True),
+    'type': Builtin(type_builtin, threaded=True),
+    'pwd': Builtin(pwd_builtin, threaded=True),
+    'cd': Builtin(cd_builtin),
+    'history': Builtin(history_builtin, threaded=True),
+    'hash': Builtin(hash_builtin),
+    'parsecache': Builtin(parsecache_builtin),
+    'jobs': Builtin(jobs_builtin),
+    'fg': Builtin(fg_bg_builtin),
+    'bg': Builtin(fg_bg_builtin),
+    'wait': Builtin(wait_builtin),
+    'kill': Builtin(kill_builtin),
+    'ulimit': Builtin(ulimit_builtin),
+    'timeout': Builtin(None),
+    'cache': Builtin(None),
+    'export': Builtin(export_builtin),
+    'unset': Builtin(unset_builtin),
+    'alias': Builtin(alias_builtin),
+    'unalias': Builtin(unalias_builtin),
+    'test': Builtin(test_builtin, threaded=True),
+    '[': Builtin(test_builtin, threaded=True),
+    'true': Builtin(true_builtin, threaded=True),
+    ':': Builtin(true_builtin, threaded=True),
+    'false': Builtin(false_builtin, threaded=True),
+    'break': Builtin(loop_control_builtin),
+    'continue': Builtin(loop_control_builtin),
+    'return': Builtin(return_builtin),
+    'shellstats': Builtin(shellstats_builtin),
+    'times': Builtin(times_builtin, threaded=True),
+    'parallel': Builtin(parallel_builtin),
+}
 
-    if current_segment.strip():
-        pipeline_segments.append(current_segment.strip())
+class SpawnedProcess:
+    """ The parts of Popen the job table uses, for children from posix_spawn """
+    __slots__ = ('pid', 'returncode')
 
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
 
-    return pipeline_segments
+    def poll(self):
+        if self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except ChildProcessError:
+                return self.returncode
+            if pid:
+                self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
 
-def parse_command_line(input_line):
-    args = []
-    current_arg = ""
-    in_single_quote = False
-    in_double_quote = False
-    i = 0
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
 
-    while i < len(input_line):
-        char = input_line[i]
+    def wait(self):
+        if self.returncode is None:
+            try:
+                _, status = os.waitpid(self.pid, 0)
+            except ChildProcessError:
+                return self.returncode
+            self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
 
-        if char == "'" and not in_double_quote:
-            in_single_quote = not in_single_quote
-        elif char == '"' and not in_single_quote:
-            in_double_quote = not in_double_quote
-        elif char == "\\":
-            if not in_double_quote and not in_single_quote:
-                if i + 1 < len(input_line):
-                    current_arg += input_line[i+1]
-                    i += 1        
-            else:
-                if i + 1 < len(input_line):
-                    if input_line[i+1] == '\\' or (input_line[i+1] == '"' and not in_single_quote):
-                        current_arg += input_line[i+1]
-                        i += 1
-                    else:
-                        current_arg += char
-        elif char == ' ' and not in_double_quote and not in_single_quote:
-            if current_arg:
-                args.append(current_arg)
-                current_arg = ""
-        else:
-            current_arg += char
+def spawn_environment():
+    """ A plain-dict snapshot of os.environ for posix_spawn
 
-        i += 1
+    Converting the os.environ mapping costs more than the spawn itself, so
+    the snapshot is reused until environment_changed() drops it.
+    """
+    global spawn_env
 
-    if current_arg:
-        args.append(current_arg)
+    if spawn_env is None:
+        spawn_env = dict(os.environ)
+    return spawn_env
 
-    return args
+def environment_changed():
+    global spawn_env
 
-def extract_stdout_redirection(args):
-    if len(args) < 2:
-        return args, None, None, False
-    
-    cleaned = []
-    stdout_path = None
-    stderr_path = None
-    append = False
-    i = 0
+    spawn_env = None
 
-    while i < len(args):
-        token = args[i]
-        if token in ('>', '1>'):
-            if i + 1 < len(args):
-                stdout_path = args[i + 1]
-                i += 2
-                continue
-            else:
-                # No filename provided; ignore malformed redirection
-                i += 1
+def spawn_process(argv, executable, stdin=None, stdout=None, stderr=None, process_group=None, limits=None, env=None):
+    """ Start an external command with os.posix_spawn
+
+    The redirections and pipe ends become dup2 file actions and the process
+    group is set by the spawn itself, so glibc can use its vfork-style clone
+    without copying the shell's page tables. Limits need code to run in the
+    child, so those commands fall back to Popen with a preexec_fn.
+    """
+    if limits or not use_posix_spawn:
+        import subprocess
+
+        return subprocess.Popen(
+            argv,
+            executable=executable,
+            stdin=stdin,
+            stdout=stdout,
+            stderr=stderr,
+            process_group=process_group,
+            env=env,
+            preexec_fn=limits_preexec(limits) if limits else None
+        )
+
+    file_actions = [
+        (os.POSIX_SPAWN_DUP2, fd, target)
+        for fd, target in ((stdin, 0), (stdout, 1), (stderr, 2))
+        if fd is not None
+    ]
+    options = {} if process_group is None else {'setpgroup': process_group}
+    pid = os.posix_spawn(
+        executable,
+        argv,
+        spawn_environment() if env is None else env,
+        file_actions=file_actions,
+        setsigmask=(),
+        setsigdef=SPAWN_DEFAULT_SIGNALS,
+        **options
+    )
+    return SpawnedProcess(pid)
+
+def forked_action_name(args):
+    """ What a forked copy of the shell was asked to run, for its errors:
+    the command name of an argv, else the shell text """
+    subject = args[0] if args else ''
+    if isinstance(subject, str):
+        return subject
+    if isinstance(subject, list):
+        if subject and isinstance(subject[0], str):
+            return subject[0]
+        return format_list(subject)
+    return format_command(subject)
+
+def fork_shell(fd_map, process_group, action, *args, close_fds=()):
+    """ Run action(*args) in a forked copy of the shell with fd_map on 0-2
+
+    For stages that must run shell code concurrently with the rest of a
+    pipeline, and for command substitution. The child's exit status is the
+    last_exit_status the action leaves. close_fds are pipe ends other stages
+    hold, which the copy must not keep open.
+    """
+    global job_control
+
+    import warnings
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with warnings.catch_warnings():
+        # Python 3.12+ warns about forking with threads running; the shell's
+        # threads only watch PATH, warm caches and flush history, and
+        # forget_threads_after_fork drops their state in the copy
+        warnings.simplefilter('ignore', DeprecationWarning)
+        pid = os.fork()
+
+    if pid == 0:
+        status = 1
+        try:
+            if process_group is not None:
+                os.setpgid(0, process_group)
+            for fd in (0, 1, 2):
+                if fd_map[fd] != fd:
+                    os.dup2(fd_map[fd], fd)
+            for fd in close_fds:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            # the copy's children are its own business, not the parent's jobs
+            jobs.clear()
+            job_control = False
+            for signum in (signal.SIGTSTP, signal.SIGHUP, signal.SIGTERM):
+                signal.signal(signum, signal.SIG_DFL)
+            if stats:
+                # timings still add up in the copy, but only the parent traces
+                stats.trace = None
+            action(*args)
+            status = last_exit_status
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 0
+        except KeyboardInterrupt:
+            status = 128 + signal.SIGINT
+        except (LoopControl, FunctionReturn) as e:
+            status = getattr(e, 'status', 0)
+        except Exception as e:
+            # say what failed rather than exiting 1 without a word
+            try:
+                os.write(2, os.fsencode(f"{forked_action_name(args)}: {e}\n"))
+            except Exception:
+                pass
+        finally:
+            try:
+                sys.stdout.flush()
+            except Exception:
+                pass
+            os._exit(status)
+
+    if process_group is not None:
+        try:
+            # set from both sides, so the group exists whichever runs first
+            os.setpgid(pid, process_group or pid)
+        except OSError:
+            pass
+    return SpawnedProcess(pid)
+
+def execute_pipeline(pipeline):
+    """ Start every stage at once, wired together with raw OS pipes """
+    global last_exit_status, last_background_pid
+
+    processes = []
+    threads = []
+    # pipe ends and redirection targets the builtin threads hold
+    thread_fds = []
+    stdin_fd = stdout_fd = next_stdin_fd = None
+    last_status = 0
+    timed = False
+    # stages share one process group: their own under job control, and always
+    # for background jobs so terminal signals don't reach them
+    pgid = 0 if job_control or pipeline.background else None
+
+    if cache_prefixed(pipeline):
+        # like bash's `time`, the prefix covers the whole pipeline
+        run_cached(pipeline)
+        return
+
+    sys.stdout.flush()
+    try:
+        for i, parsed_command in enumerate(pipeline.commands):
+            stdout_fd = None
+            next_stdin_fd = None
+            if i < len(pipeline.commands) - 1:
+                next_stdin_fd, stdout_fd = os.pipe()
+            # a forked stage holding these would keep EOF or SIGPIPE from
+            # reaching the stages around it
+            stray_fds = thread_fds if next_stdin_fd is None else thread_fds + [next_stdin_fd]
+
+            if not isinstance(parsed_command, Command):
+                # compound commands run in a copy of the shell, which applies
+                # their own redirections
+                fd_map = {0: 0 if stdin_fd is None else stdin_fd, 1: 1 if stdout_fd is None else stdout_fd, 2: 2}
+                try:
+                    process = fork_shell(fd_map, pgid, execute_command, parsed_command, close_fds=stray_fds)
+                finally:
+                    for fd in (stdin_fd, stdout_fd):
+                        if fd is not None:
+                            os.close(fd)
+                    stdin_fd = stdout_fd = None
+                if pgid == 0:
+                    pgid = process.pid
+                    if not pipeline.background:
+                        # now, not once every stage is up: a stage that reads the terminal
+                        # before it's the group's would get SIGTTIN
+                        give_terminal_to(pgid)
+                processes.append(process)
+                last_status = None
+                stdin_fd = next_stdin_fd
                 continue
 
-        if token == '2>':
-            if i + 1 < len(args):
-                stderr_path = args[i + 1]
-                i += 2
+            try:
+                parsed_command = expand_command(parsed_command)
+                assignments = expand_assignments(parsed_command)
+            except ExpansionError as e:
+                print(e, file=sys.stderr)
+                for fd in (stdin_fd, stdout_fd):
+                    if fd is not None:
+                        os.close(fd)
+                stdin_fd = next_stdin_fd
+                last_status = 1
                 continue
+            command_with_args = parsed_command.argv
 
-            i += 1
-            continue
+            if not command_with_args:
+                command_with_args = ['']
+            command = command_with_args[0]
 
-        if token in ('>>', '1>>'):
-            if i + 1 < len(args):
-                stdout_path = args[i + 1]
-                append = True
-                i += 2
+            command_limits = None
+            if command == 'timeout':
+                try:
+                    parsed_command, command_limits = split_limit_prefix(parsed_command)
+                except ValueError as e:
+                    print(f"timeout: {e}", file=sys.stderr)
+                    for fd in (stdin_fd, stdout_fd):
+                        if fd is not None:
+                            os.close(fd)
+                    stdin_fd = next_stdin_fd
+                    last_status = 125
+                    continue
+                command_with_args = parsed_command.argv
+                command = command_with_args[0]
+            if command == 'cache':
+                # its key couldn't cover what arrives on stdin
+                print("cache: only valid at the start of a pipeline", file=sys.stderr)
+                for fd in (stdin_fd, stdout_fd):
+                    if fd is not None:
+                        os.close(fd)
+                stdin_fd = next_stdin_fd
+                last_status = 2
                 continue
-            
-            i += 1
-            continue
+            limits = effective_limits(command_limits)
+            if 'T' in limits:
+                timed = True
 
-        if token == '2>>':
-            if i + 1 < len(args):
-                stderr_path = args[i + 1]
-                append = True
-                i += 2
+            # the pipe ends this stage was handed are its to close
+            owned_fds = [fd for fd in (stdin_fd, stdout_fd) if fd is not None]
+            try:
+                fd_map, opened = open_redirections(parsed_command.redirects, stdin_fd, stdout_fd)
+            except (RedirectionError, OSError) as e:
+                print(e, file=sys.stderr)
+                for fd in owned_fds:
+                    os.close(fd)
+                stdin_fd = next_stdin_fd
+                last_status = 1
                 continue
-            
-            i += 1
-            continue
+            owned_fds += opened
 
-        # support form like '>file' and '1>file'
-        if token.startswith('>') and len(token) > 1:
-            stdout_path = token[1:]
-            i += 1
-            continue
-        if token.startswith('1>') and len(token) > 2:
-            stdout_path = token[2:]
-            i += 1
-            continue
-        if token.startswith('2>') and len(token) > 2:
-            stderr_path = token[2:]
-            i += 1
-            continue
-        
-        cleaned.append(token)
-        i += 1
+            builtin = BUILTINS.get(command) if command not in functions else None
+            if builtin is not None and builtin.threaded:
+                # the thread owns every fd in owned_fds from here on
+                outcome = [0]
+                thread = threading.Thread(
+                    target=run_builtin_stage,
+                    args=(builtin, command_with_args, fd_map, owned_fds, outcome),
+                    daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+                thread_fds.extend(owned_fds)
+                stdin_fd = stdout_fd = None
+                last_status = outcome
+            elif command in functions or (builtin is not None and builtin.run is not None):
+                # functions and builtins that change shell state get a
+                # forked copy of the shell, like any other stage
+                try:
+                    action = call_function if command in functions else run_builtin
+                    process = fork_shell(fd_map, pgid, action, command_with_args, close_fds=stray_fds)
+                finally:
+                    for fd in owned_fds:
+                        os.close(fd)
+                    stdin_fd = stdout_fd = None
+                if pgid == 0:
+                    pgid = process.pid
+                    if not pipeline.background:
+                        give_terminal_to(pgid)
+                processes.append(process)
+                last_status = None
+            else:
+                try:
+                    executable_path = find_executable(command)
+                    if executable_path:
+                        process = spawn_process(
+                            command_with_args,
+                            executable_path,
+                            stdin=fd_map[0] if fd_map[0] != 0 else None,
+                            stdout=fd_map[1] if fd_map[1] != 1 else None,
+                            stderr=fd_map[2] if fd_map[2] != 2 else None,
+                            process_group=pgid,
+                            limits=limits,
+                            env=dict(spawn_environment(), **dict(assignments)) if assignments else None
+                        )
+                        if pgid == 0:
+                            pgid = process.pid
+                            if not pipeline.background:
+                                give_terminal_to(pgid)
+                        processes.append(process)
+                        last_status = None
+                    else:
+                        # to the stage's own stderr, so 2> applies to it
+                        sys.stderr.flush()
+                        os.write(fd_map[2], f"{command}: command not found\n".encode())
+                        last_status = 127
+                finally:
+                    # the child holds its own copies; ours must go so EOF propagates
+                    for fd in owned_fds:
+                        os.close(fd)
+                    stdin_fd = stdout_fd = None
 
-    return cleaned, stdout_path, stderr_path, append
+            stdin_fd = next_stdin_fd
 
-def cprint(text, file=None, append=False):
-    mode = 'w' if not append else 'a'
-    try:
-        if file:
-            with open(file, mode) as f:
-                f.write(text)
-        else:
-            print(text)
     except Exception as e:
-        print(f"Error: {e}")
+        print(f"Pipeline execution error: {e}", file=sys.stderr)
+        if pgid and not pipeline.background:
+            give_terminal_to(os.getpgrp())
+        # stages that started close their own ends; these were never handed on
+        for fd in (stdin_fd, stdout_fd, next_stdin_fd):
+            if fd is not None:
+                os.close(fd)
+        # stop what already runs, and reap it: SIGCHLD only reaps job pids
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+                try:
+                    os.kill(process.pid, signal.SIGCONT)
+                except ProcessLookupError:
+                    pass
+            process.wait()
+        for thread in threads:
+            thread.join()
+        last_exit_status = 1
+        return
 
-def completer(text, state):
-    global last_completion_text, last_matches, tab_count
+    if not processes:
+        for thread in threads:
+            thread.join()
+        last_exit_status = last_status[0] if isinstance(last_status, list) else last_status
+        return
 
-    try:
-        if not text:
-            return None
-        
-        builtin_options = []
-        external_options = []
+    job = Job(
+        number=0,
+        pgid=pgid or os.getpgrp(),
+        command_line=format_pipeline(pipeline),
+        returncodes={process.pid: None for process in processes},
+        processes=processes,
+        threads=threads
+    )
+    if pipeline.background:
+        last_background_pid = processes[-1].pid
+        add_job(job)
+        if job_control:
+            print(f"[{job.number}] {processes[-1].pid}")
+        last_exit_status = 0
+        return
 
-        all_options = last_matches
+    status = wait_for_job(job, foreground=True)
+    if timed and job.term_signal == signal.SIGALRM:
+        print(f"{job.command_line}: command time out", file=sys.stderr)
+        status = 124
+    if isinstance(last_status, list):
+        # a threaded builtin's status is only final once wait_for_job joined it
+        last_status = last_status[0]
+    last_exit_status = status if last_status is None else last_status
+    if job_control and job.term_signal == signal.SIGINT and (loop_depth or function_depth):
+        # like bash, ^C that kills a foreground child also ends the loop or
+        # function that started it
+        raise KeyboardInterrupt
 
-        if text != last_completion_text:
-            builtin_options = [cmd for cmd in list_buildin_cmd if cmd.startswith(text)]
+OUTPUT_CACHE_MEMORY = 16 << 20
+OUTPUT_CACHE_DISK = 256 << 20
 
-            executables = get_executables_in_path()
-            external_options = [exe for exe in executables if exe.startswith(text)]
+class CachedOutput:
+    __slots__ = ('command_line', 'status', 'data', 'path', 'size', 'hits')
 
-            all_options = builtin_options + external_options
-            all_options = list(set(all_options))
+    def __init__(self, command_line, status, data):
+        self.command_line = command_line
+        self.status = status
+        # the output in memory, or None once it has been spilled to path
+        self.data = data
+        self.path = None
+        self.size = len(data)
+        self.hits = 0
 
-            last_completion_text = text
-            last_matches = all_options
-            tab_count = 1
-        else:
-            tab_count += 1
+class OutputCache:
+    """ Output of `cache`-prefixed pipelines, least recently used first
 
-        if len(all_options) == 0:
+    Entries stay in memory until memory_limit is exceeded, when the oldest
+    are spilled to files in a private directory; past disk_limit the oldest
+    spilled entries are dropped.
+    """
+
+    def __init__(self, memory_limit, disk_limit):
+        self.entries = OrderedDict()
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory_used = 0
+        self.disk_used = 0
+        self.directory = None
+        self.spills = itertools.count()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
             return None
-        elif len(all_options) == 1:
-            return all_options[0] + ' ' if state == 0 else None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        entry.hits += 1
+        return entry
+
+    def read(self, entry):
+        if entry.data is not None:
+            return entry.data
+        with open(entry.path, 'rb') as f:
+            return f.read()
+
+    def put(self, key, command_line, status, data):
+        self.discard(key)
+        self.entries[key] = CachedOutput(command_line, status, data)
+        self.memory_used += len(data)
+
+        for entry in self.entries.values():
+            if self.memory_used <= self.memory_limit:
+                break
+            if entry.data is not None:
+                self.spill(entry)
+        for key in [key for key, entry in self.entries.items() if entry.path]:
+            if self.disk_used <= self.disk_limit:
+                break
+            self.discard(key)
+
+    def spill(self, entry):
+        if self.directory is None:
+            import tempfile
+
+            self.directory = tempfile.mkdtemp(prefix='shell-cache-')
+            atexit.register(self.close)
+        path = os.path.join(self.directory, str(next(self.spills)))
+        try:
+            with open(path, 'wb') as f:
+                f.write(entry.data)
+        except OSError:
+            # no room on disk either: keep it in memory over budget
+            return
+        entry.path = path
+        entry.data = None
+        self.memory_used -= entry.size
+        self.disk_used += entry.size
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        if entry.path:
+            self.disk_used -= entry.size
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
         else:
-            if tab_count == 1:
-                if state == 0:
-                    # ring the bell
-                    sys.stdout.write('\a')
-                    sys.stdout.flush()
+            self.memory_used -= entry.size
 
-                    # partial completion
-                    common_prefix = os.path.commonprefix(all_options)
-                    if (len(common_prefix) > len(text)):
-                        return common_prefix
-                
-                return None
-            
-            elif tab_count >= 2:
-                if state == 0:
-                    print()
-                    print("  ".join(sorted(all_options)))
-                    
-                    # redraw the prompt and current input
-                    sys.stdout.write("$ " + text)
-                    sys.stdout.flush()
+    def clear(self, command_line=None):
+        """ Drop every entry, or only those for command_line """
+        for key in [key for key, entry in self.entries.items()
+                    if command_line is None or entry.command_line == command_line]:
+            self.discard(key)
+
+    def close(self):
+        self.clear()
+        if self.directory:
+            try:
+                os.rmdir(self.directory)
+            except OSError:
+                pass
+
+output_cache = OutputCache(OUTPUT_CACHE_MEMORY, OUTPUT_CACHE_DISK)
+
+def split_cache_prefix(command):
+    """ Split `cache [-e name] [-w path] command ...` into the wrapped
+    Command, the variables and the paths that go into its key """
+    words = command.words
+    names = []
+    paths = []
+    i = 1
+    while i + 1 < len(words) and words[i].text in ('-e', '-w'):
+        (names if words[i].text == '-e' else paths).append(words[i + 1].text)
+        i += 2
+    if i >= len(words) or words[i].text[:1] == '-':
+        raise ValueError("usage: cache [-e name] [-w path] command [arg ...] | cache [-r [command]]")
+    # without -w, entries last as long as the directory's listing is unchanged
+    return Command(words[i:], command.redirects, command.assignments), names, paths or ['.']
 
+def substitutes_commands(steps):
+    """ Whether expansion steps run a command substitution anywhere """
+    for kind, value, _ in steps or ():
+        if kind == 'cmd' or (kind == 'arith' and substitutes_commands(value)) \
+                or (kind == 'param' and substitutes_commands(value[3])):
+            return True
+    return False
+
+def expanded_stages(pipeline):
+    """ Each stage as it would run, with words, assignments and redirection
+    targets expanded, so the cache sees $x's current value rather than its
+    source. None when the output can't be keyed: a command substitution's
+    result isn't known without running it, and a compound stage is only
+    kept while it expands nothing. """
+    stages = []
+    for command in pipeline.commands:
+        if type(command) is not Command:
+            source = format_command(command)
+            if '$' in source or '`' in source:
                 return None
-            
-        return None
-    except Exception as e:
-        print(e)
+            stages.append(source)
+            continue
+        words = itertools.chain(command.assignments, command.words, (redirect.target for redirect in command.redirects))
+        if any(substitutes_commands(word_plan(word)) for word in words):
+            return None
+        expanded = expand_command(command)
+        redirects = tuple((redirect.fd, redirect.op, redirect.target.text) for redirect in expanded.redirects)
+        stages.append((tuple(expand_assignments(command)), tuple(expanded.argv), redirects))
+    return tuple(stages)
 
-def execute_single_command(command_line):
-    command_with_args = parse_command_line(command_line)
-    command = command_with_args[0]
-    command_with_args, stdout_redirect, stderr_redirect, append = extract_stdout_redirection(command_with_args)
+def cache_key(stages, names, paths):
+    stamps = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stamps.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamps.append((path, None, None))
+    values = tuple((name, parameter_value(name)) for name in names)
+    return stages, os.getcwd(), values, tuple(stamps)
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def cache_prefixed(pipeline):
+    first = pipeline.commands[0]
+    return type(first) is Command and bool(first.words) and first.words[0].text == 'cache'
+
+def format_cached_output():
+    hits, misses = output_cache.hits, output_cache.misses
+    lines = [f"entries: {len(output_cache.entries)}, memory: {output_cache.memory_used} bytes, "
+             f"disk: {output_cache.disk_used} bytes, hits: {hits}, misses: {misses}"]
+    for entry in output_cache.entries.values():
+        where = 'disk' if entry.path else 'memory'
+        lines.append(f"{entry.hits:4}\t{entry.size:10}\t{where}\t{entry.command_line}")
+    return ''.join(line + '\n' for line in lines)
+
+def run_cached(pipeline, capture=False):
+    """ Run a pipeline prefixed with `cache`, replaying its standard output
+    when the same command line ran before with the same working directory,
+    -e variables and -w mtimes. Only successful runs are kept.
+
+    The output is written to fd 1, or with capture only returned, which is
+    how $(cache ...) keeps its entries in the shell rather than in a fork.
+    """
+    global last_exit_status
+
+    first = pipeline.commands[0]
+    args = [word.text for word in first.words[1:]]
+    if not args or args[0] == '-r':
+        data = b''
+        if args:
+            output_cache.clear(' '.join(args[1:]) or None)
+        else:
+            data = format_cached_output().encode()
+        if not capture:
+            sys.stdout.flush()
+            write_all(1, data)
+        last_exit_status = 0
+        return data
 
-    # Create/truncate redirection targets up front so files exist even if nothing is written
-    mode = 'w' if not append else 'a'
-    if stdout_redirect:
+    try:
+        command, names, paths = split_cache_prefix(first)
+    except ValueError as e:
+        print(f"cache: {e}", file=sys.stderr)
+        last_exit_status = 2
+        return b''
+    inner = Pipeline([command] + pipeline.commands[1:], pipeline.background)
+
+    redirects = getattr(inner.commands[-1], 'redirects', ())
+    # output that goes somewhere else can't be replayed
+    cacheable = not any(redirect.fd == 1 or redirect.op[0] == '&' for redirect in redirects)
+    if cacheable and (capture or not pipeline.background):
         try:
-            open(stdout_redirect, mode).close()
-        except Exception:
-            pass
-    if stderr_redirect:
+            stages = expanded_stages(inner)
+        except ExpansionError as e:
+            print(e, file=sys.stderr)
+            last_exit_status = 1
+            return b''
+        cacheable = stages is not None
+    if not capture and (pipeline.background or not cacheable):
+        execute_pipeline(inner)
+        return b''
+
+    if cacheable:
+        command_line = format_pipeline(inner)
+        key = cache_key(stages, names, paths)
+        entry = output_cache.get(key)
+        if entry is not None:
+            data = output_cache.read(entry)
+            if not capture:
+                sys.stdout.flush()
+                write_all(1, data)
+            last_exit_status = entry.status
+            return data
+
+    # the copy is a job of its own, so ^Z stops it and gives the prompt back
+    read_fd, write_fd = os.pipe()
+    try:
+        process = fork_shell({0: 0, 1: write_fd, 2: 2}, 0 if job_control else None, run_list, [inner])
+    finally:
+        os.close(write_fd)
+    if job_control:
+        give_terminal_to(process.pid)
+
+    chunks = []
+
+    def relay():
+        """ Collect the output, passing it on as it comes unless captured """
+        passing = not capture
         try:
-            open(stderr_redirect, mode).close()
-        except Exception:
-            pass
+            while chunk := os.read(read_fd, SCRIPT_OUTPUT_BUFFER):
+                chunks.append(chunk)
+                if passing:
+                    try:
+                        write_all(1, chunk)
+                    except OSError:
+                        passing = False
+        finally:
+            os.close(read_fd)
 
-    match command:
-        case "exit":
-            sys.exit(0)
-        case "echo":
-            if stdout_redirect:
-                cprint(" ".join(command_with_args[1:]) + "\n", stdout_redirect, append)
-            else:
-                cprint(" ".join(command_with_args[1:]))
-        case "type":
-            if len(command_with_args) < 2:
-                return
+    relay_thread = threading.Thread(target=relay, daemon=True)
+    relay_thread.start()
+    job = Job(
+        number=0,
+        pgid=process.pid if job_control else os.getpgrp(),
+        command_line=format_pipeline(pipeline),
+        returncodes={process.pid: None},
+        processes=[process],
+        threads=[relay_thread]
+    )
+    last_exit_status = wait_for_job(job, foreground=True)
 
-            query = command_with_args[1]
-            if query in list_buildin_cmd:
-                print(f"{query} is a shell builtin")
-            else:
-                executable_path = find_executable(query)
-                if executable_path:
-                    print(f"{query} is {executable_path}")
-                else:
-                    print(f"{query} not found")
+    # a stopped run is incomplete; its output goes on once fg resumes it
+    data = b''.join(chunks)
+    if cacheable and job.state == 'Done' and last_exit_status == 0:
+        output_cache.put(key, command_line, 0, data)
+    return data
 
-        case "pwd":
-            print(os.getcwd())
+class LoopControl(Exception):
+    """ Raised by break and continue; levels counts the loops left to unwind """
+    def __init__(self, keyword, levels):
+        self.keyword = keyword
+        self.levels = levels
 
-        case "cd":
-            try:
-                if len(command_with_args) < 2:
-                    os.chdir(Path.home())
-                    return
-                
-                if command_with_args[1] == '~':
-                    os.chdir(Path.home())
-                    return
+class FunctionReturn(Exception):
+    def __init__(self, status):
+        self.status = status
 
-                os.chdir(command_with_args[1])
-            except Exception as e:
-                print(f"cd: {command_with_args[1]}: No such file or directory")
+def run_list(pipelines):
+    """ Run a parsed list in order, skipping pipelines their && or || rules out """
+    global last_exit_status
 
-        case 'history':
-            if len(command_with_args) < 2:
-                for i, line in enumerate(history):
-                    print(f"{i+1} {line}")
-            else:
-                if command_with_args[1] == '-r':
-                    if command_with_args[2]:
-                        file_path = command_with_args[2]
-                        if os.path.exists(file_path):
-                            try:
-                                with open(file_path, 'r') as f:
-                                    file_history = [line.strip() for line in f.readlines() if line.strip()]
-                                # Append file history to current history
-                                history.extend(file_history)
-                                readline.read_history_file(file_path)
-                            except Exception as e:
-                                print(f"history: {file_path}: {e}")
-                    else:
-                        print(f"history: {command_with_args[1]}: file argument required")
-                elif command_with_args[1] == '-w':
-                    if command_with_args[2]:
-                        file_path = command_with_args[2]
-                        try:
-                            with open(file_path, 'w+') as f:
-                                f.write('\n'.join(history))
-                                f.write('\n')
-                        except Exception as e:
-                            print(f"history: {file_path}: {e}")
-                    else:
-                        print(f"history: {command_with_args[1]}: file argument required")
-                elif command_with_args[1] == '-a':
-                    if command_with_args[2]:
-                        file_path = command_with_args[2]
-                        try:
-                            last_position = history_file_positions.get(file_path, 0)
-                            history_to_write = history[last_position:]
-                            with open(file_path, 'a') as f:
-                                f.write('\n'.join(history_to_write))
-                                f.write('\n')
-                            history_file_positions[file_path] = len(history)
-                        except Exception as e:
-                            print(f"history: {file_path}: {e}")
-                    else:
-                        print(f"history: {command_with_args[1]}: file argument required")
-                else:
-                    try:
-                        num = int(command_with_args[1])
-                        if num > len(history):
-                            num = len(history)
+    for pipeline in pipelines:
+        if pipeline.connector == '&&' and last_exit_status != 0:
+            continue
+        if pipeline.connector == '||' and last_exit_status == 0:
+            continue
+
+        if len(pipeline.commands) > 1 or pipeline.background:
+            execute_pipeline(pipeline)
+        elif type(pipeline.commands[0]) is Command:
+            execute_single_command(pipeline.commands[0])
+        else:
+            execute_command(pipeline.commands[0])
+        if pipeline.negate:
+            last_exit_status = int(last_exit_status == 0)
 
-                        for i in range(num, 0, -1):
-                            idx = len(history) - i
-                            print(f"{idx+1} {history[idx]}")
-                    except ValueError:
-                        print(f"history: {command_with_args[1]}: numeric argument required")
-                        return
+def execute_command(node):
+    """ Run a simple or compound command inside the shell process """
+    global last_exit_status
 
+    match node:
+        case Command():
+            execute_single_command(node)
+        case FunctionDefinition():
+            functions[node.name] = node.body
+            last_exit_status = 0
         case _:
-            executable_path = find_executable(command)
-            if executable_path:
-                try:
-                    # [executable_path] + command_with_args[1:],
-                    result = subprocess.run(
-                        command_with_args,
-                        capture_output=True,
-                        text=True,
-                        timeout=20
-                    )
-
-                    if result.stdout:
-                        if stdout_redirect:
-                            cprint(result.stdout, stdout_redirect, append)
-                        else:
-                            print(result.stdout, end='')
-                    
-                    if result.stderr:
-                        if stderr_redirect:
-                            cprint(result.stderr, stderr_redirect, append)
-                        else:
-                            print(result.stderr, end='')
+            run_redirected(node.redirects, run_compound, node)
 
-                    # if result.returncode != 0:
-                    #     sys.exit(result.returncode)
+def run_compound(node):
+    global last_exit_status, loop_depth
 
-                except subprocess.TimeoutExpired:
-                    print(f"{command}: command time out")
-                except Exception as e:
-                    print(f"{command}: execution failed: {e}")
+    match node:
+        case If():
+            for condition, body in node.clauses:
+                run_list(condition)
+                if last_exit_status == 0:
+                    run_list(body)
+                    return
+            if node.else_body is not None:
+                run_list(node.else_body)
             else:
-                print(f"{command}: command not found")
+                last_exit_status = 0
 
-def execute_pipeline(pipeline_segments):
-    processes = []
+        case Loop():
+            status = 0
+            loop_depth += 1
+            try:
+                while True:
+                    run_list(node.condition)
+                    if (last_exit_status == 0) != (node.keyword == 'while'):
+                        break
+                    keep_going = run_loop_body(node.body)
+                    status = last_exit_status
+                    if not keep_going:
+                        break
+            finally:
+                loop_depth -= 1
+            last_exit_status = status
+
+        case For():
+            if node.words is None:
+                items = positional_parameters[1:]
+            else:
+                try:
+                    listings = {}
+                    items = [field for word in node.words for field in expand_word(word, listings)]
+                except ExpansionError as e:
+                    print(e, file=sys.stderr)
+                    last_exit_status = 1
+                    return
+
+            last_exit_status = 0
+            loop_depth += 1
+            try:
+                for item in items:
+                    set_variable(node.name, item)
+                    if not run_loop_body(node.body):
+                        break
+            finally:
+                loop_depth -= 1
+
+        case Group():
+            run_list(node.body)
 
+def run_loop_body(body):
+    """ Run one pass of a loop body; False when break ends the loop """
     try:
-        for i, segment in enumerate(pipeline_segments):
-            command_with_args = parse_command_line(segment)
-            command = command_with_args[0]
+        run_list(body)
+    except LoopControl as e:
+        if e.levels > 1:
+            e.levels -= 1
+            raise
+        return e.keyword == 'continue'
+    return True
 
-            if command in list_buildin_cmd:
-                if i == 0:
-                    # first command in pipeline - create a pipe and write to it
-                    read_pipe, write_pipe = os.pipe()
-                    with os.fdopen(write_pipe, 'w') as f:
-                        if command == "echo":
-                            f.write(" ".join(command_with_args[1:]) + "\n")
-                        elif command == "type":
-                            if len(command_with_args) >= 2:
-                                query = command_with_args[1]
-                                if query in list_buildin_cmd:
-                                    f.write(f"{query} is a shell builtin\n")
-                                else:
-                                    executable_path = find_executable(query)
-                                    if executable_path:
-                                        f.write(f"{query} is {executable_path}\n")
-                                    else:
-                                        f.write(f"{query} not found\n")
-
-                        elif command == "pwd":
-                            f.write(os.getcwd() + "\n")
-
-                    processes.append(('pipe', read_pipe))
-                elif i == len(pipeline_segments) - 1:
-                    # last command in pipeline - read from previous output
-                    if processes:
-                        if processes[-1][0] == 'pipe':
-                            with os.fdopen(processes[-1][1], 'r') as f:
-                                input_data = f.read()
-                        else:
-                            last_process = processes[-1][1]
-                            stdout, stderr = last_process.communicate()
-                            if stderr:
-                                print(stderr, end='')
-                            input_data = stdout
-
-                    # execute builtin command (most builtins ignore piped out)
-                    if command == 'echo':
-                        print(" ".join(command_with_args[1:]))
-                    elif command == 'type':
-                        if len(command_with_args) >= 2:
-                            query = command_with_args[1]
-                            if query in list_buildin_cmd:
-                                print(f"{query} is a shell builtin")
-                            else:
-                                executable_path = find_executable(query)
-                                if executable_path:
-                                    print(f"{query} is {executable_path}")
-                                else:
-                                    print(f"{query} not found")
-                    elif command == 'pwd':
-                        print(os.getcwd())
-                    elif command == 'cd':
-                        try:
-                            if len(command_with_args) < 2:
-                                os.chdir(Path.home())
-                            elif command_with_args[1] == '~':
-                                os.chdir(Path.home())
-                            else:
-                                os.chdir(command_with_args[1])
-                        except Exception as e:
-                            print(f"cd: {command_with_args[1]}: No such file or directory")
+def call_function(command_with_args):
+    global last_exit_status, function_depth
 
-                else:
-                    # middle command in pipeline - read from previous, write to next
-                    read_pipe, write_pipe = os.pipe()
+    saved_parameters = positional_parameters[1:]
+    positional_parameters[1:] = command_with_args[1:]
+    function_depth += 1
+    try:
+        execute_command(functions[command_with_args[0]])
+    except FunctionReturn as e:
+        last_exit_status = e.status
+    finally:
+        function_depth -= 1
+        positional_parameters[1:] = saved_parameters
 
-                    if processes[-1][0] == 'pipe':
-                        with os.fdopen(processes[-1][1], 'r') as f:
-                            input_data = f.read()
-                    else:
-                        last_process = processes[-1][1]
-                        stdout, stderr = last_process.communicate()
-                        if stderr:
-                            print(stderr, end='')
-                        input_data = stdout
-
-                    # Write to next
-                    with os.fdopen(write_pipe, 'w') as f:
-                        if command == "echo":
-                            f.write(" ".join(command_with_args[1:]) + "\n")
-                        elif command == "type":
-                            if len(command_with_args) >= 2:
-                                query = command_with_args[1]
-                                if query in list_buildin_cmd:
-                                    f.write(f"{query} is a shell builtin\n")
-                                else:
-                                    executable_path = find_executable(query)
-                                    if executable_path:
-                                        f.write(f"{query} is {executable_path}\n")
-                                    else:
-                                        f.write(f"{query} not found\n")
-                        elif command == "pwd":
-                            f.write(os.getcwd() + "\n")
-                    
-                    processes.append(('pipe', read_pipe))
+def run_redirected(redirects, action, *args):
+    """ Run action(*args) with the shell's own fds 0-2 redirected
 
-            else:
-                executable_path = find_executable(command)
-                if not executable_path:
-                    print(f"{command}: command not found")
-                    return
+    Compound commands and functions run shell code that may start children,
+    so their redirections go on the real descriptors, restored afterwards.
+    """
+    global last_exit_status
 
-                stdin_source = None
-                if processes and processes[-1][0] == 'pipe':
-                    stdin_source = processes[-1][1]
-                elif processes and processes[-1][0] == 'process':
-                    stdin_source = processes[-1][1].stdout
-
-                stdout_dest = None
-                if i < len(pipeline_segments) - 1:
-                    stdout_dest = subprocess.PIPE
-
-                process = subprocess.Popen(
-                    command_with_args,
-                    stdin=stdin_source,
-                    stdout=stdout_dest,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
+    if not redirects:
+        return action(*args)
 
-                processes.append(('process', process))
+    try:
+        fd_map, opened = open_redirections(expand_command(Command([], redirects)).redirects)
+    except (ExpansionError, RedirectionError, OSError) as e:
+        print(e, file=sys.stderr)
+        last_exit_status = 1
+        return
 
-                #! CRITICAL
-                 # Close the previous process's stdout so it can receive EOF
-                if i > 0 and processes[-2][0] == 'process':
-                    processes[-2][1].stdout.close()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = []
+    try:
+        for fd in (0, 1, 2):
+            if fd_map[fd] != fd:
+                saved.append((fd, os.dup(fd)))
+                os.dup2(fd_map[fd], fd)
+    finally:
+        for fd in opened:
+            os.close(fd)
 
-        # Wait for all external processes to complete
-        for process_type, process in processes:
-            if process_type == 'process':
-                stdout, stderr = process.communicate()
-                if stderr:
-                    print(stderr, end='')
+    try:
+        return action(*args)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, copy in saved:
+            os.dup2(copy, fd)
+            os.close(copy)
 
-    except Exception as e:
-        print(f"Pipeline execution error: {e}")
-        # clean up any remaning processes
-        for process in processes:
-            if process.poll() is None:
-                process.terminate()
+def command_complete(input_line):
+    """ False while input_line stops inside a command that needs more lines """
+    try:
+        parse_cached(input_line)
+    except IncompleteCommand:
+        return False
+    except ShellSyntaxError:
+        pass
+    return True
 
-def execute_builtin_with_input(command, command_with_args, input_data):
-    # execute a builtin command with piped input
-    if command == "echo":
-        print(" ".join(command_with_args[1:]))
-    elif command == "type":
-        if len(command_with_args) >= 2:
-            query = command_with_args[1]
-            if query in list_buildin_cmd:
-                print(f"{query} is a shell builtin")
-            else:
-                executable_path = find_executable(query)
-                if executable_path:
-                    print(f"{query} is {executable_path}")
-                else:
-                    print(f"{query} not found")
+# reserved words after which a command carries on, so a ';' can't follow
+COMMAND_CONTINUES = frozenset(('if', 'then', 'elif', 'else', 'while', 'until', 'do', '{', '!'))
+
+def history_entry(input_line):
+    """ A command typed over several lines as one history line, the way
+    bash's cmdhist saves it: lines join with '; ', or a space where a ';'
+    would be a syntax error, and stay apart inside quotes and after a comment """
+    lines = input_line.split('\n')
+    entry = lines[0]
+    for line in lines[1:]:
+        try:
+            tokens = tokenize(entry)
+            # a trailing comment swallows whatever is put after it
+            commented = len(tokenize(entry + ' x')) == len(tokens)
+        except IncompleteCommand:
+            # inside quotes, or after a backslash
+            commented = True
+        if commented:
+            entry += '\n' + line
+            continue
+        if not line.strip():
+            continue
+
+        last = tokens[-1] if tokens else None
+        before = tokens[-2] if len(tokens) > 1 else None
+        if not isinstance(last, Word):
+            # after | && || ; & ( a command follows directly, and f() takes a body
+            separator = '; ' if last == (')', None) and before != ('(', None) else ' '
+        elif plain_word(last) in COMMAND_CONTINUES and (not isinstance(before, Word) or plain_word(before) in COMMAND_CONTINUES):
+            separator = ' '
+        else:
+            separator = '; '
+        entry += separator + line.lstrip()
+    return entry
+
+def run_line(input_line):
+    global last_exit_status
+
+    if stats:
+        stats.begin_line()
+    try:
+        pipelines = parse_cached(input_line)
+    except ShellSyntaxError as e:
+        print(e)
+        last_exit_status = 2
+        return
     else:
-        # For other builtins, we'll just execute them normally
-        # The piped input will be ignored
-        execute_single_command(" ".join(command_with_args))
+        run_list(pipelines)
+    finally:
+        if stats:
+            stats.end_line(input_line)
+
+def run_script(lines):
+    """ Run commands non-interactively: no prompt, readline or history """
+    # one block-buffered writer for all builtin output, flushed before any
+    # child process is started and on the way out
+    sys.stdout.flush()
+    sys.stdout = io.TextIOWrapper(
+        io.BufferedWriter(io.FileIO(sys.stdout.fileno(), 'w', closefd=False), SCRIPT_OUTPUT_BUFFER),
+        encoding=sys.stdout.encoding,
+        errors=sys.stdout.errors,
+        write_through=False
+    )
+    try:
+        pending = ''
+        for input_line in lines:
+            input_line = pending + input_line.rstrip('\n')
+            if not input_line.strip():
+                continue
+            if stats:
+                stats.begin_line()
+            try:
+                pipelines = parse_cached(input_line)
+            except IncompleteCommand:
+                # compound commands span lines; gather them before running
+                pending = input_line + '\n'
+                continue
+            except ShellSyntaxError as e:
+                # like any POSIX shell, a syntax error ends a script
+                print(e)
+                sys.exit(2)
+            pending = ''
+            run_list(pipelines)
+            if stats:
+                stats.end_line(input_line)
+        if pending:
+            print("syntax error: unexpected end of file")
+            sys.exit(2)
+    finally:
+        sys.stdout.flush()
 
+    sys.exit(last_exit_status)
 
+def enable_job_control():
+    global job_control
 
-def main():
+    job_control = True
+    # a handler rather than SIG_IGN, so children still get the default action
+    signal.signal(signal.SIGTSTP, lambda signum, frame: None)
+
+def save_history_and_die(signum, frame):
+    """ SIGHUP/SIGTERM: write out buffered history, then die of the signal """
+    try:
+        history_file.close()
+    except OSError as e:
+        print(f"Failed to write to history file {history_file.path}: {e.strerror}", file=sys.stderr)
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+def interactive_loop():
+    global readline, history_file, history_index, last_exit_status
+    import readline
+
+    enable_job_control()
+    path_index_warming.set()
+    threading.Thread(target=warm_command_index, daemon=True).start()
     readline.set_completer(completer)
+    # words break only where the shell's own lexer would split them
+    readline.set_completer_delims(' \t\n|&;<>')
     doc = readline.__doc__ or ""
     if "libedit" in doc:
         readline.parse_and_bind("bind ^I rl_complete")
@@ -584,38 +4162,115 @@ def main():
         readline.parse_and_bind("tab: complete")
 
     histfile = os.environ.get("HISTFILE")
-    if histfile and os.path.exists(histfile):
+    if histfile:
         try:
-            with open(histfile, 'r') as f:
-                file_history = [line.strip() for line in f.readlines() if line.strip()]
-            history.extend(file_history)
-            try:
-                readline.read_history_file(histfile)
-            except Exception:
-                pass
+            flush_interval = float(os.environ.get("HISTFLUSHINTERVAL", 5))
+        except ValueError:
+            flush_interval = 5.0
+        history_file = HistoryFile(histfile, flush_interval)
+        atexit.register(history_file.close)
+        signal.signal(signal.SIGHUP, save_history_and_die)
+        signal.signal(signal.SIGTERM, save_history_and_die)
+        # build the search index off the prompt's critical path
+        history_index = HistoryIndex(histfile)
+        threading.Thread(target=history_index.update, daemon=True).start()
+        try:
+            history_file.load()
         except Exception as e:
             print(f"Failed to read history from {histfile}: {e}")
 
     while True:
+        notify_jobs()
         # Wait for user input with readline
-        input_line = input("$ ")
+        try:
+            input_line = input("$ ")
+        except EOFError:
+            print()
+            sys.exit(last_exit_status)
+        except KeyboardInterrupt:
+            print()
+            continue
         if input_line == "":
             continue
-        
-        history.append(input_line)
-        if histfile:
-            try:
-                with open(histfile, 'a') as f:
-                    f.write(input_line + "\n")
-            except Exception as e:
-                print(f"Failed to write to history file {histfile}: {e}")
-        pipeline_segments = parse_pipeline(input_line)
+        recorded = readline.get_current_history_length()
+        try:
+            while not command_complete(input_line):
+                input_line += "\n" + input("> ")
+        except EOFError:
+            print()
+        except KeyboardInterrupt:
+            print()
+            continue
+
+        try:
+            expanded_line = expand_history(input_line)
+        except ShellSyntaxError as e:
+            print(e)
+            continue
+        if expanded_line != input_line:
+            # like bash, show and remember the command that actually runs
+            input_line = expanded_line
+            print(input_line)
 
-        if len(pipeline_segments) > 1:
-            execute_pipeline(pipeline_segments)
+        # input() already recorded each line with readline; like bash's
+        # cmdhist, keep the command as a single entry instead
+        ensure_history_loaded()
+        entry = history_entry(input_line)
+        for _ in range(readline.get_current_history_length() - recorded):
+            readline.remove_history_item(recorded)
+        if recorded:
+            readline.replace_history_item(recorded - 1, entry)
+        if history.add(entry, os.environ.get('HISTCONTROL', '').split(':')):
+            trim_history()
+            if history_file:
+                try:
+                    history_file.append(entry)
+                except Exception as e:
+                    print(f"Failed to write to history file {histfile}: {e}")
         else:
-            execute_single_command(input_line)
-        
+            # HISTCONTROL dropped it, so up-arrow shouldn't offer it either
+            length = readline.get_current_history_length()
+            if length:
+                readline.remove_history_item(length - 1)
+
+        try:
+            run_line(input_line)
+        except KeyboardInterrupt:
+            print()
+            last_exit_status = 128 + signal.SIGINT
+
+def main():
+    args = sys.argv[1:]
+    signal.signal(signal.SIGCHLD, reap_jobs)
+    # data is bytes: whatever isn't UTF-8 passes through as surrogate escapes
+    for stream in (sys.stdin, sys.stdout, sys.stderr):
+        stream.reconfigure(errors='surrogateescape')
+    if os.environ.get('SHELLSTATS') or os.environ.get('SHELLTRACE'):
+        try:
+            enable_stats(os.environ.get('SHELLTRACE') or None)
+        except OSError as e:
+            print(f"SHELLTRACE: {e.strerror}", file=sys.stderr)
+
+    if args and args[0] == '-c':
+        if len(args) < 2:
+            print("-c: option requires an argument")
+            sys.exit(2)
+        positional_parameters[:] = args[2:] or positional_parameters
+        run_script(args[1].splitlines())
+    elif args:
+        try:
+            script = open(args[0], errors='surrogateescape')
+        except OSError as e:
+            print(f"{args[0]}: {e.strerror}")
+            sys.exit(127)
+        positional_parameters[:] = args
+        with script:
+            run_script(script)
+    elif not sys.stdin.isatty():
+        run_script(sys.stdin)
+    else:
+        interactive_loop()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,71 @@
+"""Measure tab-completion latency against 50k PATH executables and 50k files.
+
+Run from the repository root:
+
+    python3 -m bench.bench_completion [candidates]
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+from app import main as shell
+
+PREFIXES = ['a', 'bin', 'bin_1', 'bin_12', 'bin_123', 'bin_1234', 'zz']
+
+
+def populate(directory, count, executable):
+    for n in range(count):
+        path = os.path.join(directory, f"bin_{n}")
+        with open(path, 'w'):
+            pass
+        if executable:
+            os.chmod(path, 0o755)
+
+
+def time_call(func, *args, repeat=200):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(*args)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def tab_press(text):
+    # a fresh text each time, so every call is a real first tab press
+    shell.last_completion_text = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        shell.completer(text, 0)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    with tempfile.TemporaryDirectory() as tmp:
+        bin_dir = os.path.join(tmp, 'bin')
+        files_dir = os.path.join(tmp, 'files')
+        os.mkdir(bin_dir)
+        os.mkdir(files_dir)
+        populate(bin_dir, count, executable=True)
+        populate(files_dir, count, executable=False)
+        os.environ['PATH'] = bin_dir
+
+        start = time.perf_counter()
+        shell.get_command_names()
+        print(f"candidates: {count}")
+        print(f"cold command index build: {(time.perf_counter() - start) * 1e3:.1f} ms")
+
+        start = time.perf_counter()
+        shell.list_directory(files_dir)
+        print(f"cold directory listing: {(time.perf_counter() - start) * 1e3:.1f} ms")
+
+        print(f"{'prefix':>10} {'matches':>8} {'command us':>11} {'file us':>9}")
+        for prefix in PREFIXES:
+            matches = len(shell.prefix_matches(shell.get_command_names(), prefix))
+            command_us = time_call(tab_press, prefix)
+            file_us = time_call(shell.complete_filename, os.path.join(files_dir, prefix))
+            print(f"{prefix:>10} {matches:>8} {command_us:>11.1f} {file_us:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Time the history builtin on a large history held in app.main's HistoryList.
+
+Fills the history with distinct command lines, then times a full listing,
+`history 10`, `history -w`, `history -a` after a few more commands, a
+search, and random access to entry N. Every output goes to /dev/null or a
+temporary file. Also reports the store's size next to what a plain list of
+str would take.
+
+Run from the repository root:
+
+    python3 -m bench.bench_history [entries]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from app import main as shell
+
+
+def timed(label, func, *args):
+    start = time.perf_counter()
+    func(*args)
+    seconds = time.perf_counter() - start
+    print(f"{label:<24} {seconds * 1000:10.2f} ms")
+
+
+def run_history(devnull, *args):
+    shell.history_builtin(['history', *args], None, devnull, devnull)
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 300_000
+    lines = [f"grep -rn 'pattern {i}' src/module_{i % 97}/ | sort | head -{i % 50}" for i in range(entries)]
+
+    start = time.perf_counter()
+    shell.history.extend(lines)
+    print(f"entries: {entries:,}   built in {(time.perf_counter() - start) * 1000:.1f} ms")
+    store = len(shell.history.buffer) + shell.history.offsets.itemsize * len(shell.history.offsets)
+    as_list = sys.getsizeof(lines) + sum(sys.getsizeof(line) for line in lines)
+    print(f"store: {store / (1 << 20):.1f} MiB   as list of str: {as_list / (1 << 20):.1f} MiB")
+
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, 'w') as devnull:
+        target = os.path.join(tmp, 'histfile')
+        timed("history", run_history, devnull)
+        timed("history 10", run_history, devnull, '10')
+        timed("history -w", run_history, devnull, '-w', target)
+        shell.history.extend(lines[:5])
+        timed("history -a (5 new)", run_history, devnull, '-a', target)
+        timed("history -s 'pattern 4242'", run_history, devnull, '-s', 'pattern 4242')
+
+        picks = [random.randrange(entries) for _ in range(100_000)]
+        start = time.perf_counter()
+        for i in picks:
+            shell.history[i]
+        per_lookup = (time.perf_counter() - start) / len(picks)
+        print(f"{'entry N':<24} {per_lookup * 1e6:10.2f} us")
+
+
+if __name__ == "__main__":
+    main()
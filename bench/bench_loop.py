@@ -0,0 +1,62 @@
+"""Compare a counting loop using the in-process test builtin against one
+that runs /usr/bin/test on every iteration.
+
+Both scripts run the same `while` loop through app.main; the first uses
+the `test` builtin, the second names the external binary, so each pass
+costs one spawn.
+
+Run from the repository root:
+
+    python3 -m bench.bench_loop [iterations]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+LOOP = """\
+i=0
+while {test} $i -lt {iterations}; do
+  i=$((i + 1))
+done
+echo $i
+"""
+
+
+def run_loop(test, iterations):
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, 'loop.sh')
+        with open(script, 'w') as f:
+            f.write(LOOP.format(test=test, iterations=iterations))
+
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-u', '-m', 'app.main', script],
+            stdout=subprocess.PIPE,
+            text=True,
+            check=True
+        )
+        elapsed = time.perf_counter() - start
+
+    if result.stdout.strip() != str(iterations):
+        raise SystemExit(f"{test}: loop ended at {result.stdout.strip()!r}, expected {iterations}")
+    return elapsed
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    external = shutil.which('test') or '/usr/bin/test'
+
+    builtin_seconds = run_loop('test', iterations)
+    external_seconds = run_loop(external, iterations)
+
+    print(f"iterations: {iterations:,}")
+    print(f"builtin test:   {builtin_seconds:7.3f} s   {builtin_seconds / iterations * 1e6:8.1f} us/iteration")
+    print(f"{external}: {external_seconds:7.3f} s   {external_seconds / iterations * 1e6:8.1f} us/iteration")
+    print(f"speedup: x{external_seconds / builtin_seconds:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Time parse_line on growing input lines to check that parsing scales linearly.
+
+Run from the repository root:
+
+    python3 -m bench.bench_parse
+"""
+import time
+
+from app.main import parse_line
+
+SIZES = [1 << 17, 1 << 18, 1 << 19, 1 << 20, 1 << 21]
+SAMPLE = """grep -n "some pattern" 'single quoted arg' plain\\ escaped 2>>errs.log | """
+
+
+def make_line(size):
+    # cut between stages, so no quote is left open
+    line = SAMPLE * (size // len(SAMPLE) + 1)
+    return line[:line.rfind(' | ', 0, size)] + ' | tail'
+
+
+def best_of(func, arg, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print(f"{'bytes':>10} {'seconds':>10} {'MB/s':>8} {'us/KB':>8}")
+    for size in SIZES:
+        line = make_line(size)
+        elapsed = best_of(parse_line, line)
+        print(f"{size:>10} {elapsed:>10.4f} {size / elapsed / 1e6:>8.2f} {elapsed * 1e6 / (size / 1024):>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Measure binary throughput through a pipeline run by app.main.
+
+A block of random bytes (not valid UTF-8) is written to a temporary file and
+`cat`ed repeatedly into `cat | cat | sha256sum`, so the data crosses three
+pipes the shell set up. The digest is checked against the expected one, and
+the same pipeline run by /bin/sh gives the baseline. The shell never touches
+the bytes itself: the stages' pipe ends are handed straight to the children.
+
+Command substitution and here-strings are the places the shell does read
+the data, so a short round trip through both is checked first.
+
+Run from the repository root:
+
+    python3 -m bench.bench_pipe [MiB]
+"""
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BLOCK_MIB = 16
+ROUND_TRIP = """\
+data=$(cat {path})
+cat <<< "$data" > {path}.here
+echo "$data" > {path}.echo
+"""
+
+
+def run_shell(argv, script):
+    start = time.perf_counter()
+    result = subprocess.run(argv + ['-c', script], stdout=subprocess.PIPE, check=True)
+    return result.stdout, time.perf_counter() - start
+
+
+def check_round_trip(tmp):
+    data = bytes(range(1, 256)) * 64 + b'\xff\xfe\xc3('
+    path = os.path.join(tmp, 'round-trip')
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    run_shell([sys.executable, '-m', 'app.main'], ROUND_TRIP.format(path=path))
+    for suffix in ('.here', '.echo'):
+        with open(path + suffix, 'rb') as f:
+            if f.read() != data + b'\n':
+                raise SystemExit(f"round trip through {suffix[1:]} changed the bytes")
+
+
+def main():
+    mib = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    blocks = max(1, mib // BLOCK_MIB)
+    total = blocks * BLOCK_MIB << 20
+
+    with tempfile.TemporaryDirectory() as tmp:
+        check_round_trip(tmp)
+
+        block = os.path.join(tmp, 'block')
+        data = os.urandom(BLOCK_MIB << 20)
+        with open(block, 'wb') as f:
+            f.write(data)
+        expected = hashlib.sha256()
+        for _ in range(blocks):
+            expected.update(data)
+
+        script = f"cat {' '.join([block] * blocks)} | cat | cat | sha256sum"
+        results = {}
+        for label, argv in (('app.main', [sys.executable, '-m', 'app.main']), ('/bin/sh', ['/bin/sh'])):
+            output, seconds = run_shell(argv, script)
+            if output.split()[0].decode() != expected.hexdigest():
+                raise SystemExit(f"{label}: digest mismatch, the pipeline corrupted the data")
+            results[label] = seconds
+
+    print(f"bytes: {total:,} (round trip ok, digests match)")
+    for label, seconds in results.items():
+        print(f"{label:<10} {seconds:7.3f} s   {total / seconds / (1 << 20):8.1f} MiB/s")
+    print(f"ratio: x{results['/bin/sh'] / results['app.main']:.2f} of /bin/sh throughput")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Measure non-interactive throughput on a 100k-line script of builtins.
+
+Run from the repository root:
+
+    python3 -m bench.bench_script [lines]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BUILTIN_LINES = [
+    "echo benchmark line {n}",
+    "pwd",
+    "type echo",
+    "echo 'quoted {n}' \"and double\" plain",
+    "type cd",
+]
+
+
+def write_script(path, lines):
+    with open(path, 'w') as f:
+        for n in range(lines):
+            f.write(BUILTIN_LINES[n % len(BUILTIN_LINES)].format(n=n) + "\n")
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, 'bench.sh')
+        write_script(script, lines)
+
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-u', '-m', 'app.main', script],
+            stdout=subprocess.DEVNULL,
+            check=True
+        )
+        elapsed = time.perf_counter() - start
+
+    print(f"lines: {lines}")
+    print(f"seconds: {elapsed:.3f}")
+    print(f"commands/s: {lines / elapsed:,.0f}")
+
+
+if __name__ == "__main__":
+    main()
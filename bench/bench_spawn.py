@@ -0,0 +1,53 @@
+"""Compare spawns per second for the posix_spawn launcher and Popen.
+
+Each round starts /bin/true through app.main.spawn_process and waits for it,
+first with a small heap and then after inflating the shell's heap (as a large
+loaded history would), where fork-style launchers get slower.
+
+Run from the repository root:
+
+    python3 -m bench.bench_spawn [spawns] [heap MB]
+"""
+import os
+import shutil
+import sys
+import time
+
+from app import main as shell
+
+
+def spawns_per_second(count):
+    true = shutil.which('true')
+    start = time.perf_counter()
+    for _ in range(count):
+        process = shell.spawn_process(['true'], true)
+        os.waitpid(process.pid, 0)
+        process.returncode = 0
+    return count / (time.perf_counter() - start)
+
+
+def run_round(label, count):
+    rates = {}
+    for launcher, enabled in (('posix_spawn', True), ('Popen', False)):
+        shell.use_posix_spawn = enabled
+        spawns_per_second(count // 10)
+        rates[launcher] = spawns_per_second(count)
+    shell.use_posix_spawn = hasattr(os, 'posix_spawn')
+
+    print(f"{label:<16} posix_spawn {rates['posix_spawn']:8.0f}/s   Popen {rates['Popen']:8.0f}/s"
+          f"   x{rates['posix_spawn'] / rates['Popen']:.2f}")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    heap_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+
+    run_round("small heap", count)
+    heap = [bytearray(1 << 20) for _ in range(heap_mb)]
+    for block in heap:
+        block[::4096] = b'x' * len(block[::4096])
+    run_round(f"{heap_mb} MB heap", count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Measure shell startup against the budget tracked in startup_budget.json.
+
+Reports the median of several runs for:
+  - c_true_ms: spawn to exit of `main.py -c true`
+  - first_prompt_ms: spawn to the first "$ " on a pty
+  - first_prompt_100k_history_ms: the same with a 100k-line $HISTFILE
+
+Run from the repository root; exits non-zero when a budget is exceeded:
+
+    python3 -m bench.bench_startup [runs]
+"""
+import json
+import os
+import pty
+import select
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BUDGET_FILE = os.path.join(os.path.dirname(__file__), 'startup_budget.json')
+SHELL = [sys.executable, '-m', 'app.main']
+
+
+def child_env(**extra):
+    env = dict(os.environ)
+    # measure with cached bytecode, as a deployed shell would run
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env.pop('HISTFILE', None)
+    env.update(extra)
+    return env
+
+
+def time_c_true():
+    start = time.perf_counter()
+    subprocess.run(SHELL + ['-c', 'true'], env=child_env(), check=True)
+    return (time.perf_counter() - start) * 1e3
+
+
+def time_first_prompt(env):
+    start = time.perf_counter()
+    pid, fd = pty.fork()
+    if pid == 0:
+        os.execve(sys.executable, SHELL, env)
+
+    output = b''
+    try:
+        while b'$ ' not in output:
+            ready, _, _ = select.select([fd], [], [], 5)
+            if not ready:
+                raise RuntimeError("no prompt within 5s")
+            output += os.read(fd, 4096)
+        return (time.perf_counter() - start) * 1e3
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        os.close(fd)
+
+
+def median_of(runs, func, *args):
+    func(*args)  # warm the page cache and bytecode cache
+    return statistics.median(func(*args) for _ in range(runs))
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    with open(BUDGET_FILE) as f:
+        budget = json.load(f)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        histfile = os.path.join(tmp, 'history')
+        with open(histfile, 'w') as f:
+            for n in range(100_000):
+                f.write(f"echo history line {n} | grep {n % 97}\n")
+
+        results = {
+            'c_true_ms': median_of(runs, time_c_true),
+            'first_prompt_ms': median_of(runs, time_first_prompt, child_env()),
+            'first_prompt_100k_history_ms': median_of(runs, time_first_prompt, child_env(HISTFILE=histfile)),
+        }
+
+    over = False
+    for name, value in results.items():
+        limit = budget.get(name)
+        status = 'ok' if limit is None or value <= limit else 'OVER'
+        over = over or status == 'OVER'
+        print(f"{name:<32} {value:8.1f} ms   budget {limit} ms   {status}")
+
+    sys.exit(1 if over else 0)
+
+
+if __name__ == "__main__":
+    main()
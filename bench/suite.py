@@ -0,0 +1,385 @@
+"""End-to-end benchmark suite with a stored baseline.
+
+Runs every group below in a fresh interpreter, so module state (PATH caches,
+history) and peak memory don't leak from one group into the next:
+
+  parse     parse_line throughput on one long line and on typical lines
+  lookup    find_executable and tab completion against a synthetic PATH tree
+  pipeline  binary throughput and shell memory for a multi-stage pipe,
+            and short pipelines per second
+  history   loading, saving and holding a 1M-entry history, and the first
+            prompt on a pty with that history in $HISTFILE
+  startup   `-c true`, the first prompt and per-command round trips on a pty,
+            and script throughput
+
+Each group runs --repeat times and every metric keeps its best value.
+Results go to bench/results.json and are compared with bench/baseline.json;
+the run exits non-zero if a metric is worse than the baseline by more than
+the tolerance. Metric names carry their unit: _ms and _us are times and
+_mib sizes (lower is better), _per_s and _mib_s rates (higher is better).
+
+Run from the repository root:
+
+    python3 -m bench.suite [--quick] [--only parse,lookup] [--repeat 3] [--tolerance 0.25]
+    python3 -m bench.suite --save-baseline
+"""
+import argparse
+import json
+import os
+import platform
+import pty
+import resource
+import select
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.bench_parse import make_line, best_of
+from bench.bench_script import write_script
+from bench.bench_startup import SHELL, child_env, median_of, time_c_true, time_first_prompt
+
+BENCH_DIR = os.path.dirname(__file__)
+RESULTS_FILE = os.path.join(BENCH_DIR, 'results.json')
+BASELINE_FILE = os.path.join(BENCH_DIR, 'baseline.json')
+
+TYPICAL_LINES = [
+    "ls -la /tmp | grep -v total | sort -k5 -n > sizes.txt",
+    "echo \"$HOME/$USER\" 'single quoted' plain\\ escaped 2>>errors.log",
+    "for f in *.py; do wc -l \"$f\"; done",
+    "if test -d build; then rm -r build; else mkdir build && cd build; fi",
+    "x=$((x + 1)); echo ${name:-default} $(pwd)",
+    "find . -name '*.log' -mtime +7 | xargs rm -f &",
+]
+
+UNITS = (
+    ('_mib_s', 'MiB/s', 'higher'),
+    ('_per_s', '/s', 'higher'),
+    ('_mib', 'MiB', 'lower'),
+    ('_ms', 'ms', 'lower'),
+    ('_us', 'us', 'lower'),
+)
+
+
+def metric_unit(name):
+    for suffix, unit, better in UNITS:
+        if name.endswith(suffix):
+            return unit, better
+    raise ValueError(f"{name}: metric name has no unit suffix")
+
+
+def bench_parse(quick):
+    from app.main import parse_line
+
+    size = 1 << 18 if quick else 1 << 20
+    line = make_line(size)
+    elapsed = best_of(parse_line, line)
+
+    lines = TYPICAL_LINES * (500 if quick else 5000)
+    start = time.perf_counter()
+    for line in lines:
+        parse_line(line)
+    per_line = (time.perf_counter() - start) / len(lines)
+
+    return {
+        'parse_long_line_mib_s': size / elapsed / (1 << 20),
+        'parse_lines_per_s': 1 / per_line,
+    }
+
+
+def synthetic_path(root, dirs, per_dir):
+    path = []
+    for d in range(dirs):
+        directory = os.path.join(root, f"bin{d}")
+        os.mkdir(directory)
+        for n in range(per_dir):
+            name = os.path.join(directory, f"cmd_{d}_{n}")
+            with open(name, 'w'):
+                pass
+            os.chmod(name, 0o755)
+        path.append(directory)
+    return ':'.join(path)
+
+
+def per_call_us(func, args, repeat, batches=3):
+    """ Mean microseconds per call in the fastest of several batches """
+    best = float('inf')
+    for _ in range(batches):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best / repeat * 1e6
+
+
+def bench_lookup(quick):
+    import contextlib
+    import io
+
+    from app import main as shell
+
+    dirs, per_dir = (10, 500) if quick else (20, 2500)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['PATH'] = synthetic_path(tmp, dirs, per_dir)
+        last = f"cmd_{dirs - 1}_{per_dir - 1}"
+
+        cold_ms = float('inf')
+        for _ in range(3):
+            shell.path_dir_cache.clear()
+            shell.hashed_commands.clear()
+            start = time.perf_counter()
+            shell.find_executable(last)
+            cold_ms = min(cold_ms, (time.perf_counter() - start) * 1e3)
+
+        hashed_us = per_call_us(shell.find_executable, (last,), 10_000)
+        miss_us = per_call_us(shell.find_executable, ('no_such_command',), 1_000)
+
+        start = time.perf_counter()
+        shell.get_command_names()
+        index_ms = (time.perf_counter() - start) * 1e3
+
+        def tab_press(text):
+            shell.last_completion_text = None
+            with contextlib.redirect_stdout(io.StringIO()):
+                shell.completer(text, 0)
+
+        prefixes = ['c', 'cmd_1', 'cmd_1_1', f"cmd_{dirs - 1}_{per_dir - 1}", 'zz']
+        completion_us = statistics.median(per_call_us(tab_press, (prefix,), 50) for prefix in prefixes)
+
+    return {
+        'lookup_cold_scan_ms': cold_ms,
+        'lookup_hashed_us': hashed_us,
+        'lookup_miss_us': miss_us,
+        'completion_index_ms': index_ms,
+        'completion_tab_us': completion_us,
+    }
+
+
+def run_shell(args):
+    start = time.perf_counter()
+    subprocess.run(SHELL + args, env=child_env(), stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def bench_pipeline(quick):
+    mib = 32 if quick else 256
+    with tempfile.TemporaryDirectory() as tmp:
+        data = os.path.join(tmp, 'data')
+        with open(data, 'wb') as f:
+            block = os.urandom(1 << 20)
+            for _ in range(mib):
+                f.write(block)
+        seconds = min(run_shell(['-c', f"cat {data} | cat | cat | cat > /dev/null"]) for _ in range(3))
+        # this group's only other children are cat and the short pipelines below
+        max_rss_mib = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+        count = 100 if quick else 500
+        script = os.path.join(tmp, 'pipes.sh')
+        with open(script, 'w') as f:
+            for n in range(count):
+                f.write(f"echo line {n} | cat | cat > /dev/null\n")
+        pipes_seconds = run_shell([script])
+
+    return {
+        'pipeline_4_stage_mib_s': mib / seconds,
+        'pipeline_shell_max_rss_mib': max_rss_mib,
+        'pipeline_short_per_s': count / pipes_seconds,
+    }
+
+
+def bench_history(quick):
+    from app import main as shell
+
+    entries = 100_000 if quick else 1_000_000
+    with tempfile.TemporaryDirectory() as tmp:
+        histfile = os.path.join(tmp, 'history')
+        with open(histfile, 'w') as f:
+            for n in range(entries):
+                f.write(f"git commit -m 'change {n}' && echo done {n % 97}\n")
+
+        start = time.perf_counter()
+        shell.add_to_history(shell.read_history_lines(histfile))
+        load_ms = (time.perf_counter() - start) * 1e3
+        store_mib = (len(shell.history.buffer) + shell.history.offsets.itemsize * len(shell.history.offsets)) / (1 << 20)
+
+        with open(os.devnull, 'w') as devnull:
+            start = time.perf_counter()
+            shell.history_builtin(['history', '-w', os.path.join(tmp, 'saved')], None, devnull, devnull)
+            save_ms = (time.perf_counter() - start) * 1e3
+
+            start = time.perf_counter()
+            shell.history_builtin(['history', '10'], None, devnull, devnull)
+            tail_us = (time.perf_counter() - start) * 1e6
+
+        prompt_ms = median_of(3, time_first_prompt, child_env(HISTFILE=histfile))
+
+    return {
+        'history_load_ms': load_ms,
+        'history_save_ms': save_ms,
+        'history_tail_us': tail_us,
+        'history_store_mib': store_mib,
+        'history_first_prompt_ms': prompt_ms,
+    }
+
+
+def pty_round_trip_ms(commands, batches=5):
+    """ Mean time from sending `echo x` on a pty to the next prompt, in the
+    fastest of several batches """
+    pid, fd = pty.fork()
+    if pid == 0:
+        os.execve(sys.executable, SHELL, child_env())
+
+    def read_prompt():
+        output = b''
+        while not output.endswith(b'$ '):
+            ready, _, _ = select.select([fd], [], [], 5)
+            if not ready:
+                raise RuntimeError("no prompt within 5s")
+            output += os.read(fd, 4096)
+
+    try:
+        read_prompt()
+        best = float('inf')
+        for _ in range(batches):
+            start = time.perf_counter()
+            for _ in range(commands):
+                os.write(fd, b"echo x\n")
+                read_prompt()
+            best = min(best, time.perf_counter() - start)
+        return best / commands * 1e3
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        os.close(fd)
+
+
+def bench_startup(quick):
+    runs = 3 if quick else 10
+    lines = 20_000 if quick else 100_000
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, 'script.sh')
+        write_script(script, lines)
+        script_seconds = run_shell([script])
+
+    return {
+        'startup_c_true_ms': median_of(runs, time_c_true),
+        'startup_first_prompt_ms': median_of(runs, time_first_prompt, child_env()),
+        'pty_command_ms': pty_round_trip_ms(20 if quick else 100),
+        'script_commands_per_s': lines / script_seconds,
+    }
+
+
+GROUPS = {
+    'parse': bench_parse,
+    'lookup': bench_lookup,
+    'pipeline': bench_pipeline,
+    'history': bench_history,
+    'startup': bench_startup,
+}
+
+
+def run_group(name, quick, repeat):
+    """ Run one group in fresh interpreters and keep each metric's best value
+
+    Whole runs on a shared machine tend to be uniformly fast or slow, so the
+    best of a few runs is far more stable than any single one.
+    """
+    args = [sys.executable, '-m', 'bench.suite', '--group', name]
+    if quick:
+        args.append('--quick')
+    best = {}
+    for _ in range(repeat):
+        result = subprocess.run(args, stdout=subprocess.PIPE, text=True, check=True)
+        for metric, value in json.loads(result.stdout).items():
+            _, better = metric_unit(metric)
+            if metric not in best:
+                best[metric] = value
+            else:
+                best[metric] = min(best[metric], value) if better == 'lower' else max(best[metric], value)
+    return best
+
+
+def compare(metrics, baseline, tolerance):
+    """ Print each metric against the baseline; return the regressed names """
+    regressed = []
+    print(f"{'metric':<30} {'value':>12} {'baseline':>12} {'change':>8}")
+    for name, value in metrics.items():
+        unit, better = metric_unit(name)
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<30} {value:>12.2f} {'-':>12} {'new':>8}  {unit}")
+            continue
+        change = (value - base) / base if base else 0.0
+        worse = change > tolerance if better == 'lower' else change < -tolerance / (1 + tolerance)
+        status = 'REGRESSED' if worse else ''
+        if worse:
+            regressed.append(name)
+        print(f"{name:<30} {value:>12.2f} {base:>12.2f} {change:>+8.1%}  {unit} {status}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the shell and compare with a stored baseline")
+    parser.add_argument('--quick', action='store_true', help="smaller inputs and fewer runs")
+    parser.add_argument('--only', help="comma-separated groups: " + ','.join(GROUPS))
+    parser.add_argument('--repeat', type=int, default=3, help="runs per group; each metric keeps its best")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown before a metric fails (0.25 = 25%%)")
+    parser.add_argument('--output', default=RESULTS_FILE)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true', help="write the results as the new baseline")
+    parser.add_argument('--group', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.group:
+        json.dump(GROUPS[args.group](args.quick), sys.stdout)
+        return
+
+    names = args.only.split(',') if args.only else list(GROUPS)
+    unknown = [name for name in names if name not in GROUPS]
+    if unknown:
+        parser.error(f"unknown group: {', '.join(unknown)}")
+
+    metrics = {}
+    for name in names:
+        print(f"running {name}...", file=sys.stderr)
+        metrics.update(run_group(name, args.quick, args.repeat))
+
+    results = {
+        'mode': 'quick' if args.quick else 'full',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'metrics': metrics,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+        f.write('\n')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=4)
+            f.write('\n')
+        print(f"baseline saved to {args.baseline}")
+        return
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {'mode': results['mode'], 'metrics': {}}
+    if baseline['mode'] != results['mode']:
+        print(f"baseline was a {baseline['mode']} run; rerun {'with' if baseline['mode'] == 'quick' else 'without'} --quick to compare")
+        sys.exit(2)
+
+    regressed = compare(metrics, baseline['metrics'], args.tolerance)
+    print(f"results written to {args.output}")
+    if regressed:
+        print(f"regressed beyond {args.tolerance:.0%}: {', '.join(regressed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()